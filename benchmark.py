@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# Micro-benchmarks that time the optimized code paths against the original implementations and check that both
+# produce identical output on the studies in a database
+
+import argparse
+import os
+import re
+import sqlite3
+import string
+import subprocess
+import timeit
+
+import numpy as np
+
+import inference
+import mm_vectorize
+import model_artifact
+import re_classify
+import segment
+import transliterate
+
+REMOVE_PUNC = str.maketrans({key: None for key in string.punctuation})
+# characters checked by the ascii benchmark on top of the studies: Latin letters without a decomposition (Polish,
+# French, Nordic and African names), IPA and modifier letters, currency, fractions, circled characters, negated
+# mathematical operators, angle brackets, the figure space, formatting characters and combining marks
+ASCII_EXTRA_CHARACTERS = (
+    '\u0110\u0111\u0126\u0127\u0131\u0138\u0141\u0142\u0149\u014a\u014b\u0152\u0153\u0166\u0167\u0180\u0181'
+    '\u0187\u0188\u0189\u018a\u0190\u0191\u0192\u0195\u0197\u01a2\u01a3\u01b5\u01b6\u01e2\u01e3\u01fe\u01ff'
+    '\u0237\u023a\u023b\u0243\u0246\u0247\u20a1\u20a3\u20a4\u20a7\u20a9\u20aa\u20ab\u20ac\u20b1\u20b9'
+    '\u20ba\u20bd\u2150\u2155\u215b\u215f\u2189\u2460\u2473\u24b6\u24d0\u24ea\u21ae\u21cd\u2216\u2223\u2225'
+    '\u2236\u2241\u2262\u2278\u22d8\u22d9\u3008\u3009\u2007\u200b\u200c\u200d\u200e\u202a\u202e\u2060\u2061'
+    '\u2062\u2063\u2066\u2069\ufeff\u02bc\u02c6\u02c8\u02cb\u02cd\u02d0\u02dc\u02dd'
+) + ''.join(map(chr, list(range(0x0253, 0x02ac)) + list(range(0x0300, 0x0370)) + list(range(0x20d0, 0x20f1))))
+
+
+def reference_filter_study(ec):
+    """original filter_study() from ml_classify.py"""
+    lines = []
+    segments = re.split(
+        r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
+        ec, flags=re.MULTILINE)
+    for i, l in enumerate(segments):
+        l = l.strip()
+        if l:
+            l = l.translate(REMOVE_PUNC).strip()
+            if l:
+                lines.append(l)
+    return '\n'.join(lines)
+
+
+def reference_split_sentences(ec):
+    """original segmentation loop from print_study.filter_study()"""
+    lines = []
+    segments = re.split(
+        r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
+        ec, flags=re.MULTILINE)
+    for i, l in enumerate(segments):
+        l = l.strip()
+        if l:
+            if l:
+                if ' ' in l and l[-1] not in string.punctuation:
+                    l += '.'
+                lines.append(l)
+    return lines
+
+
+def reference_match_segment(l):
+    """original first-match loop from re_classify.score_text()"""
+    for rx, v in re_classify.REGEXES:
+        if rx.search(l):
+            return rx, v
+    return None
+
+
+def reference_features_to_text(features, text):
+    """original features_to_text() from mm_vectorize.py; consumes the feature list"""
+    i = 0
+    orig_length = len(text)
+    new_text = ''
+    f = None
+    while i < orig_length:
+        if f is None:
+            if len(features):
+                f = features.pop(0)
+            else:
+                new_text += text[i:]
+                break
+        if i == f[1]:
+            new_text += ' '.join(f[0]) + ' '
+            i += f[2]
+            f = None
+        else:
+            new_text += text[i:f[1]]
+            i = f[1]
+    return new_text
+
+
+def reference_to_ascii(text):
+    """original iconv call from print_study.filter_study() and manual_annotator.py print --ascii, in a UTF-8 locale"""
+    cp = subprocess.run(['iconv', '-t', 'ascii//TRANSLIT'], input=text, stdout=subprocess.PIPE, universal_newlines=True,
+                        env=dict(os.environ, LC_ALL='C.UTF-8'))
+    return cp.stdout
+
+
+def word_features(text):
+    """Returns non-overlapping (tokens, start, length) features replacing every other word of text"""
+    return [(['C%07d' % (hash(m.group()) % 10000000)], m.start(), m.end() - m.start())
+            for n, m in enumerate(re.finditer(r'\w+', text)) if n % 2 == 0]
+
+
+def load_criteria(db_path):
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('SELECT NCTId, EligibilityCriteria FROM studies ORDER BY NCTId')
+    rows = [(row[0], row[1] or '') for row in c.fetchall()]
+    conn.close()
+    return rows
+
+
+def compare(name, rows, reference, optimized, what='studies'):
+    """Raises an AssertionError naming the first study for which the two implementations disagree"""
+    for study_id, text in rows:
+        expected = reference(text)
+        actual = optimized(text)
+        assert expected == actual, "%s output differs for %s:\n%r\n%r" % (name, study_id, expected, actual)
+    print("%s: output identical for %s %s" % (name, len(rows), what))
+
+
+def report(name, reference_time, optimized_time):
+    print("%s: reference %.3fs, optimized %.3fs (%.1fx)" %
+          (name, reference_time, optimized_time, reference_time / optimized_time))
+
+
+def bench_segment(rows, ns):
+    compare('filter_study', rows, reference_filter_study, segment.filter_study)
+    compare('split_sentences', rows, reference_split_sentences, segment.split_sentences)
+    texts = [row[1] for row in rows]
+    report('filter_study',
+           timeit.timeit(lambda: [reference_filter_study(t) for t in texts], number=ns.repeat),
+           timeit.timeit(lambda: segment.filter_studies(texts), number=ns.repeat))
+    if ns.processes:
+        assert segment.filter_studies(texts, processes=ns.processes) == segment.filter_studies(texts)
+        report('filter_studies (%s processes)' % ns.processes,
+               timeit.timeit(lambda: [reference_filter_study(t) for t in texts], number=ns.repeat),
+               timeit.timeit(lambda: segment.filter_studies(texts, processes=ns.processes), number=ns.repeat))
+
+
+def bench_regex(rows, ns):
+    segments = []
+    for study_id, text in rows:
+        for blk in re_classify.split_blocks(text):
+            segments.extend(l.strip() for l in re_classify.split_segments(blk.strip()) if l)
+    compare('match_segment', [(i, l) for i, l in enumerate(segments)],
+            reference_match_segment, re_classify.match_segment, 'segments')
+    report('match_segment over %s segments' % len(segments),
+           timeit.timeit(lambda: [reference_match_segment(l) for l in segments], number=ns.repeat),
+           timeit.timeit(lambda: [re_classify.match_segment(l) for l in segments], number=ns.repeat))
+
+
+def bench_mm(rows, ns):
+    # repeat each text to get the long documents the original quadratic implementation struggles with
+    docs = [(study_id, text * ns.multiplier) for study_id, text in rows]
+    features = {study_id: word_features(text) for study_id, text in docs}
+    docs = dict(docs)
+    compare('features_to_text', [(study_id, study_id) for study_id in docs],
+            lambda study_id: reference_features_to_text(list(features[study_id]), docs[study_id]),
+            lambda study_id: mm_vectorize.features_to_text(features[study_id], docs[study_id]))
+    report('features_to_text (texts repeated %sx)' % ns.multiplier,
+           timeit.timeit(lambda: [reference_features_to_text(list(features[k]), docs[k]) for k in docs],
+                         number=ns.repeat),
+           timeit.timeit(lambda: [mm_vectorize.features_to_text(features[k], docs[k]) for k in docs],
+                         number=ns.repeat))
+
+
+def bench_ascii(rows, ns):
+    conn = sqlite3.connect(ns.db_path)
+    c = conn.cursor()
+    c.execute('SELECT NCTId, BriefTitle, Condition FROM studies ORDER BY NCTId')
+    titles = {row[0]: '%s\n%s\n' % (row[1] or '', row[2] or '') for row in c.fetchall()}
+    conn.close()
+    docs = [(study_id, titles.get(study_id, '') + text) for study_id, text in rows]
+    # each character follows a letter, so combining marks are checked the way they appear in decomposed (NFD) text
+    docs.append(('extra characters', ' '.join('e' + c for c in ASCII_EXTRA_CHARACTERS)))
+    compare('to_ascii', docs, reference_to_ascii, transliterate.to_ascii)
+    texts = [text for study_id, text in docs]
+    report('to_ascii_all',
+           timeit.timeit(lambda: [reference_to_ascii(t) for t in texts], number=ns.repeat),
+           timeit.timeit(lambda: transliterate.to_ascii_all(texts), number=ns.repeat))
+
+
+def bench_inference(rows, ns):
+    reference = model_artifact.load(ns.model)
+    scorer = inference.from_model(reference)
+    texts = segment.filter_studies([text for study_id, text in rows])
+    labels, values = reference.score(texts)
+    for (study_id, text), label, value, (actual_label, actual_value) in zip(
+            rows, labels, values, (scorer.score([t]) for t in texts)):
+        difference = abs(np.asarray(actual_value[0]) - value).max()
+        assert actual_label[0] == label and difference <= ns.tolerance, \
+            "inference output differs for %s: %s %s, %s %s" % (study_id, label, value, actual_label[0], actual_value[0])
+    print("inference: labels identical and decision values within %g for %s studies" % (ns.tolerance, len(rows)))
+    report('score one study at a time',
+           timeit.timeit(lambda: [reference.score([t]) for t in texts], number=ns.repeat),
+           timeit.timeit(lambda: [scorer.score([t]) for t in texts], number=ns.repeat))
+    report('score all studies at once',
+           timeit.timeit(lambda: reference.score(texts), number=ns.repeat),
+           timeit.timeit(lambda: scorer.score(texts), number=ns.repeat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', metavar='FILE', dest='db_path', default='studies_all.sqlite',
+                        help='SQLite database file to benchmark against')
+    parser.add_argument('-r', dest='repeat', type=int, default=5, help='number of timed passes over the corpus')
+    subparsers = parser.add_subparsers(dest='subcmd', title='subcommand')
+    subparsers.required = True
+
+    parser_segment = subparsers.add_parser('segment', help='segment.filter_study vs the original filter_study')
+    parser_segment.add_argument('-p', dest='processes', type=int, default=None,
+                                help='also time filter_studies with a pool of this many processes')
+
+    subparsers.add_parser('regex', help='re_classify.match_segment vs trying each of REGEXES in turn')
+
+    parser_mm = subparsers.add_parser('mm', help='mm_vectorize.features_to_text vs the original implementation')
+    parser_mm.add_argument('-m', dest='multiplier', type=int, default=10,
+                           help='number of times each eligibility criteria text is repeated')
+
+    subparsers.add_parser('ascii', help='transliterate.to_ascii vs one iconv process per study (requires iconv)')
+
+    parser_inference = subparsers.add_parser('inference', help='inference.LinearScorer vs the exported vectorizer, '
+                                                               'chi2 selection and LinearSVC')
+    parser_inference.add_argument('-m', dest='model', default='models/cancer_hiv.pickle',
+                                  help='pickled payload or compact model directory exported by ml_classify.py')
+    parser_inference.add_argument('-t', dest='tolerance', type=float, default=1e-9,
+                                  help='largest allowed difference between decision function values')
+
+    ns = parser.parse_args()
+    rows = load_criteria(ns.db_path)
+    if ns.subcmd == 'segment':
+        bench_segment(rows, ns)
+    elif ns.subcmd == 'regex':
+        bench_regex(rows, ns)
+    elif ns.subcmd == 'mm':
+        bench_mm(rows, ns)
+    elif ns.subcmd == 'ascii':
+        bench_ascii(rows, ns)
+    elif ns.subcmd == 'inference':
+        bench_inference(rows, ns)
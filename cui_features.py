@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Integer-coded CUI features, kept separate from the text n-grams instead of being appended to the document text
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+
+
+def split_cuis(cui_lines):
+    """Returns the individual CUIs (negated ones keep their N prefix) of a study's CUI lines"""
+    return [cui for line in cui_lines for cui in line.split()]
+
+
+class CUIVectorizer(object):
+    """
+    Maps the CUI lines of each study to a sparse matrix with one column per CUI. weighting is 'count' for raw counts
+    or 'tfidf' for the smoothed IDF weighting and L2 row normalization TfidfVectorizer uses.
+    """
+
+    def __init__(self, weighting='tfidf'):
+        super().__init__()
+        if weighting not in ('count', 'tfidf'):
+            raise ValueError("weighting must be 'count' or 'tfidf'")
+        self.weighting = weighting
+
+    def get_params(self, deep=True):
+        return {'weighting': self.weighting}
+
+    def count(self, docs):
+        """Returns the CUI count matrix of docs; CUIs outside the vocabulary are ignored"""
+        indices = []
+        indptr = [0]
+        for cui_lines in docs:
+            indices.extend(i for i in map(self.vocabulary_.get, split_cuis(cui_lines)) if i is not None)
+            indptr.append(len(indices))
+        X = sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(docs), len(self.vocabulary_)))
+        X.sum_duplicates()
+        return X
+
+    def weight(self, X):
+        if self.weighting == 'tfidf':
+            X.data *= self.idf_[X.indices]
+            X = normalize(X, norm='l2', copy=False)
+        return X
+
+    def fit_transform(self, docs):
+        docs = list(docs)
+        cuis = sorted(set(cui for cui_lines in docs for cui in split_cuis(cui_lines)))
+        self.vocabulary_ = {cui: i for i, cui in enumerate(cuis)}
+        X = self.count(docs)
+        if self.weighting == 'tfidf':
+            df = np.bincount(X.indices, minlength=len(cuis))
+            self.idf_ = np.log((1 + X.shape[0]) / (1 + df)) + 1
+        else:
+            self.idf_ = None
+        return self.weight(X)
+
+    def fit(self, docs):
+        self.fit_transform(docs)
+        return self
+
+    def transform(self, docs):
+        return self.weight(self.count(list(docs)))
+
+    def get_feature_names(self):
+        return sorted(self.vocabulary_, key=self.vocabulary_.get)
+
+
+class TextCUIVectorizer(object):
+    """
+    Vectorizes (text, CUI lines) documents as the text features of text_vectorizer followed by the CUI features of
+    cui_vectorizer
+    """
+
+    def __init__(self, text_vectorizer, cui_vectorizer):
+        super().__init__()
+        self.text_vectorizer = text_vectorizer
+        self.cui_vectorizer = cui_vectorizer
+
+    def get_params(self, deep=True):
+        return {
+            'text_vectorizer': [type(self.text_vectorizer).__name__, self.text_vectorizer.get_params()],
+            'cui_vectorizer': [type(self.cui_vectorizer).__name__, self.cui_vectorizer.get_params()],
+        }
+
+    def fit_transform(self, docs):
+        docs = list(docs)
+        return sp.hstack([self.text_vectorizer.fit_transform([text for text, cui_lines in docs]),
+                          self.cui_vectorizer.fit_transform([cui_lines for text, cui_lines in docs])], format='csr')
+
+    def fit(self, docs):
+        self.fit_transform(docs)
+        return self
+
+    def transform(self, docs):
+        docs = list(docs)
+        return sp.hstack([self.text_vectorizer.transform([text for text, cui_lines in docs]),
+                          self.cui_vectorizer.transform([cui_lines for text, cui_lines in docs])], format='csr')
+
+    def get_feature_names(self):
+        return list(self.text_vectorizer.get_feature_names()) + self.cui_vectorizer.get_feature_names()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# SQLite store of the MetaMap CUI lines of each study, read by NCTId instead of loading a whole JSON/pickle dump
+
+import argparse
+import json
+import os
+import pickle
+import sqlite3
+import sys
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+# stays well below SQLite's default limit on the number of bound parameters
+QUERY_BATCH_SIZE = 500
+
+
+def create_cuis_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS cuis (NCTId text PRIMARY KEY, mtime real, size integer, cuis text)")
+
+
+def is_sqlite(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+class CUIStore(object):
+    """
+    Read-only access to the cuis table written by extract_cuis.py --db or by the convert subcommand. Only the rows
+    that are asked for are read.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.conn = sqlite3.connect(path)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, study_id):
+        c = self.conn.cursor()
+        c.execute("SELECT cuis FROM cuis WHERE NCTId=?", [study_id])
+        row = c.fetchone()
+        if row is None:
+            raise KeyError(study_id)
+        return json.loads(row[0])
+
+    def __contains__(self, study_id):
+        c = self.conn.cursor()
+        c.execute("SELECT 1 FROM cuis WHERE NCTId=?", [study_id])
+        return c.fetchone() is not None
+
+    def get_many(self, study_ids):
+        """Returns a dict of the CUI lines of the given studies; studies missing from the store are left out"""
+        study_ids = list(study_ids)
+        result = {}
+        c = self.conn.cursor()
+        for i in range(0, len(study_ids), QUERY_BATCH_SIZE):
+            batch = study_ids[i:i + QUERY_BATCH_SIZE]
+            c.execute("SELECT NCTId, cuis FROM cuis WHERE NCTId IN (%s)" % ','.join('?' * len(batch)), batch)
+            for study_id, cuis in c.fetchall():
+                result[study_id] = json.loads(cuis)
+        return result
+
+
+def load_dump(path):
+    """Loads a complete CUI dump written as JSON (extract_cuis.py) or as a pickle (extract_cuis_I.py)"""
+    if os.path.splitext(path)[1].lower() == '.json':
+        with open(path) as f:
+            return json.load(f)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_cuis(path, study_ids):
+    """
+    Returns a dict of the CUI lines of the given studies from a CUI store, or from a JSON/pickle dump for files that
+    have not been converted yet
+    """
+    if is_sqlite(path):
+        with CUIStore(path) as store:
+            return store.get_many(study_ids)
+    data = load_dump(path)
+    return {study_id: data[study_id] for study_id in study_ids if study_id in data}
+
+
+def convert(src_path, dst_path):
+    """Writes the contents of a JSON/pickle CUI dump into the cuis table of a SQLite database"""
+    data = load_dump(src_path)
+    conn = sqlite3.connect(dst_path)
+    create_cuis_table(conn)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO cuis VALUES(?, NULL, NULL, ?)",
+                         ((study_id, json.dumps(cuis)) for study_id, cuis in sorted(data.items())))
+    conn.close()
+    return len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='subcmd', title='subcommand')
+    subparsers.required = True
+
+    parser_convert = subparsers.add_parser('convert', help='convert a JSON or pickle CUI dump into a CUI store')
+    parser_convert.add_argument('src', help='JSON (.json) or pickle CUI dump')
+    parser_convert.add_argument('dst', help='SQLite database the cuis table is written to')
+
+    parser_show = subparsers.add_parser('show', help='print the CUI lines of studies')
+    parser_show.add_argument('src', help='CUI store or dump')
+    parser_show.add_argument('study_ids', metavar='NCTId', nargs='+')
+
+    ns = parser.parse_args()
+    if ns.subcmd == 'convert':
+        print("Converted %s studies" % convert(ns.src, ns.dst))
+    elif ns.subcmd == 'show':
+        cuis = load_cuis(ns.src, ns.study_ids)
+        for study_id in ns.study_ids:
+            if study_id not in cuis:
+                sys.stderr.write("%s not found\n" % study_id)
+                continue
+            print(study_id)
+            for line in cuis[study_id]:
+                print('    ' + line.replace('\n', ' '))
@@ -1,43 +1,120 @@
 #!/usr/bin/env python3
+# Extracts the CUIs of every MetaMap XML file in a directory, either as one JSON dump or into an incremental SQLite store
 
+import argparse
 import json
+import multiprocessing
 import os
+import sqlite3
 import sys
-import xml.etree.ElementTree as ET
+
+from cui_store import create_cuis_table
+from metamap_xml import SEMANTIC_TYPES, iter_phrase_mappings
+
 
 def extract_cuis(filename):
     """
     Returns a a list of the CUIs extracted from the study's MetaMap XML file
     """
-    with open(filename) as f:
-        f.readline()  # workaround for non-XML first line
-        root = ET.fromstring(f.read())
-        cui_lines = []
-
-        for phrase in root.findall('.//Phrase'):
-            cuis = []
-            mapping = phrase.find('.//Mapping')  # use first mapping only
-            if mapping:
-                for candidate in mapping.findall('.//Candidate'):
-                    cui = candidate.find('CandidateCUI').text
-                    sem_types = set([st.text for st in candidate.findall('.//SemType')])
-                    if sem_types & {'aapp', 'dsyn', 'fndg', 'lbpr', 'lbtr', 'moft', 'phsu', 'topp', 'virs'}:
-                        if int(candidate.find('Negated').text) == 1:
-                            cui = 'N' + cui
-                        cuis.append(cui)
-            if len(cuis):
-                cui_lines.append('\n'.join(cuis))
-        return cui_lines
+    cui_lines = []
+    for mappings in iter_phrase_mappings(filename):
+        cuis = []
+        if mappings:  # use first mapping only
+            for candidate in mappings[0].candidates:
+                if candidate.sem_types & SEMANTIC_TYPES:
+                    cui = candidate.cui
+                    if candidate.negated:
+                        cui = 'N' + cui
+                    cuis.append(cui)
+        if len(cuis):
+            cui_lines.append('\n'.join(cuis))
+    return cui_lines
+
+
+def list_xml_files(path):
+    """Returns (NCTId, filename, mtime, size) for each MetaMap XML file in a directory, sorted by NCTId"""
+    files = []
+    for entry in os.scandir(path):
+        study_id, ext = os.path.splitext(entry.name)
+        if ext.lower() == '.xml' and entry.is_file():
+            st = entry.stat()
+            files.append((study_id, entry.path, st.st_mtime, st.st_size))
+    files.sort()
+    return files
+
+
+def stale_files(conn, files):
+    """Returns the files that are not in the cuis table or whose mtime or size changed since they were extracted"""
+    c = conn.cursor()
+    c.execute("SELECT NCTId, mtime, size FROM cuis")
+    extracted = {row[0]: (row[1], row[2]) for row in c.fetchall()}
+    return [f for f in files if extracted.get(f[0]) != (f[2], f[3])]
+
+
+def removed_studies(conn, files):
+    """Returns the NCTIds in the cuis table whose XML file is no longer in the listing"""
+    listed = set(f[0] for f in files)
+    return [row[0] for row in conn.execute("SELECT NCTId FROM cuis ORDER BY NCTId") if row[0] not in listed]
+
+
+def extract_file(f):
+    """Returns the (NCTId, mtime, size, CUI list as JSON) row for one (NCTId, filename, mtime, size) tuple"""
+    study_id, filename, mtime, size = f
+    return study_id, mtime, size, json.dumps(extract_cuis(filename))
+
+
+def extract_files(files, processes=None, chunksize=16):
+    """Yields the extracted rows for files in order, optionally spreading the parsing across a process pool"""
+    if processes and processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            yield from pool.imap(extract_file, files, chunksize=chunksize)
+    else:
+        yield from map(extract_file, files)
+
 
 if __name__ == '__main__':
-    path = sys.argv[1]
-    data = {}
-    i = 0
-    for fn in os.listdir(path):
-        study_id, ext = os.path.splitext(fn)
-        if ext.lower() == '.xml':
-            i += 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', metavar='FILE', dest='db_path', default=None,
+                        help='store the CUIs in the cuis table of this SQLite database and only parse the files that '
+                             'are new or changed since the last run (rows of removed files are deleted), instead of '
+                             'printing a JSON dump of all files')
+    parser.add_argument('-j', dest='processes', type=int, default=None,
+                        help='number of worker processes used to parse the files')
+    parser.add_argument('-n', dest='batch_size', type=int, default=500,
+                        help='number of extracted files committed per transaction (with --db)')
+    parser.add_argument('path', help='directory containing the MetaMap XML output files, named <NCTId>.xml')
+    ns = parser.parse_args()
+
+    files = list_xml_files(ns.path)
+    if ns.db_path is None:
+        data = {}
+        for i, (study_id, mtime, size, cuis) in enumerate(extract_files(files, ns.processes), 1):
             sys.stderr.write(str(i) + ' ' + study_id + '\n')
-            data[study_id] = extract_cuis(os.path.join(path, fn))
-    print(json.dumps(data))
+            data[study_id] = json.loads(cuis)
+        print(json.dumps(data))
+        sys.exit(0)
 
+    conn = sqlite3.connect(ns.db_path)
+    create_cuis_table(conn)
+    conn.commit()
+    removed = removed_studies(conn, files)
+    with conn:
+        conn.executemany("DELETE FROM cuis WHERE NCTId=?", [(study_id,) for study_id in removed])
+    files = stale_files(conn, files)
+    sys.stderr.write("%s new or changed files, %s removed\n" % (len(files), len(removed)))
+    batch = []
+    counter = 0
+    for row in extract_files(files, ns.processes):
+        batch.append(row)
+        if len(batch) >= ns.batch_size:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO cuis VALUES(?, ?, ?, ?)", batch)
+            counter += len(batch)
+            sys.stderr.write("[%s] %s\n" % (counter, batch[-1][0]))
+            batch = []
+    if batch:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO cuis VALUES(?, ?, ?, ?)", batch)
+        counter += len(batch)
+    print("Extracted %s files" % counter)
+    conn.close()
@@ -4,7 +4,8 @@ import os
 import pickle
 import sqlite3
 import sys
-import xml.etree.ElementTree as ET
+
+from metamap_xml import SEMANTIC_TYPES, iter_phrase_mappings
 
 DATABASE = 'studies.sqlite'
 METAMAP_XML_DIR = 'metamap_out'
@@ -14,39 +15,33 @@ def extract_cuis(study_id):
     """
     Returns a a list of the CUIs extracted from the study's MetaMap XML file
     """
-    with open(os.path.join(METAMAP_XML_DIR, study_id + '.xml')) as f:
-        f.readline()  # workaround for non-XML first line
-        root = ET.fromstring(f.read())
-        cui_lines = []
+    cui_lines = []
 
-        # for x in root.find('.//Negations'):
-        #     neg_type = x.find('NegType').text
-        #     neg_trigger = x.find('.//NegTriggerPI')
-        #     neg_pos = int(neg_trigger.find('StartPos').text)
-        #     neg_length = int(neg_trigger.find('Length').text)
-        #     features[neg_pos] = (neg_type, neg_length)
-        #     names[neg_type] = neg_type
-        #     ncui = x.find('.//NegConcCUI').text
+    # for x in root.find('.//Negations'):
+    #     neg_type = x.find('NegType').text
+    #     neg_trigger = x.find('.//NegTriggerPI')
+    #     neg_pos = int(neg_trigger.find('StartPos').text)
+    #     neg_length = int(neg_trigger.find('Length').text)
+    #     features[neg_pos] = (neg_type, neg_length)
+    #     names[neg_type] = neg_type
+    #     ncui = x.find('.//NegConcCUI').text
 
-        for phrase in root.findall('.//Phrase'):
-            cuis = set()
-            mappings = phrase.findall('.//Mapping')
-            if len(mappings):
-                best_score = 0
-                for mapping in mappings:
-                    score = abs(int(mapping.find('MappingScore').text))
-                    if score >= best_score:
-                        best_score = score
-                        for candidate in mapping.findall('.//Candidate'):
-                            cui = candidate.find('CandidateCUI').text
-                            concept = candidate.find('CandidatePreferred').text
-                            sem_types = set([st.text for st in candidate.findall('.//SemType')])
-                            if sem_types & {'aapp', 'dsyn', 'fndg', 'lbpr', 'lbtr', 'moft', 'phsu', 'topp', 'virs'}:
-                                if int(candidate.find('Negated').text) == 1:
-                                    cui = 'N' + cui
-                                cuis.add(cui)
-            cui_lines.append('\n'.join(cuis))
-        return cui_lines
+    for mappings in iter_phrase_mappings(os.path.join(METAMAP_XML_DIR, study_id + '.xml')):
+        cuis = set()
+        if len(mappings):
+            best_score = 0
+            for mapping in mappings:
+                score = abs(mapping.score)
+                if score >= best_score:
+                    best_score = score
+                    for candidate in mapping.candidates:
+                        if candidate.sem_types & SEMANTIC_TYPES:
+                            cui = candidate.cui
+                            if candidate.negated:
+                                cui = 'N' + cui
+                            cuis.add(cui)
+        cui_lines.append('\n'.join(cuis))
+    return cui_lines
 
 if __name__ == '__main__':
 
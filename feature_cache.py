@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# On-disk cache of fitted vectorizer vocabularies and document-term matrices
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+from cui_features import CUIVectorizer, TextCUIVectorizer
+from hashing_features import HashingTfidfVectorizer
+from study_text import RULES_VERSION
+
+CACHE_VERSION = 1
+
+
+def file_digest(path):
+    """Returns the SHA-1 hex digest of a file's contents"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def studies_digest(db_path, annotation):
+    """
+    Returns the SHA-1 hex digest of the NCTIds, eligibility criteria and annotation column values of the studies
+    annotated in that column, the rows ml_classify.load_documents() reads
+    """
+    h = hashlib.sha1()
+    conn = sqlite3.connect(db_path)
+    c = conn.execute('SELECT studies.NCTId, studies.EligibilityCriteria, annotations.%s \
+        FROM studies, annotations WHERE studies.NCTId=annotations.NCTId \
+        AND annotations.%s IS NOT NULL ORDER BY studies.NCTId' % (annotation, annotation))
+    for row in c:
+        h.update(json.dumps(row).encode('utf-8'))
+    conn.close()
+    return h.hexdigest()
+
+
+def cache_key(config, vectorizer):
+    """
+    Returns a key covering everything the cached features depend on: the annotated studies, the annotation column
+    and label merges selected by the config, the study_text preprocessing rules, the CUI file contents, and the
+    vectorizer parameters. Other changes to the database, such as study_text refresh, keep the key.
+    """
+    key_data = {
+        'version': CACHE_VERSION,
+        'studies': studies_digest(config['database'], config['annotation']),
+        'rules_version': RULES_VERSION,
+        'annotation': config['annotation'],
+        'merge': config.get('merge', []),
+        'cui_file': file_digest(config['cui_file']) if config.get('cui_file') else None,
+        'vectorizer': [type(vectorizer).__name__, vectorizer.get_params()],
+    }
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+def save_vocabulary(path, vectorizer, prefix=''):
+    """
+    Writes the fitted vocabulary (newline-separated, in column order) and IDF weights as .npy arrays, or the document
+    frequencies of a HashingTfidfVectorizer. The text and CUI parts of a TextCUIVectorizer are written separately.
+    """
+    if isinstance(vectorizer, TextCUIVectorizer):
+        save_vocabulary(path, vectorizer.text_vectorizer)
+        save_vocabulary(path, vectorizer.cui_vectorizer, 'cui_')
+        return
+    if isinstance(vectorizer, HashingTfidfVectorizer):  # no vocabulary, only the document frequencies
+        np.save(os.path.join(path, prefix + 'df_indices.npy'), vectorizer.df_indices_)
+        np.save(os.path.join(path, prefix + 'df.npy'), np.append(vectorizer.df_, vectorizer.n_docs_))
+        return
+    terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+    np.save(os.path.join(path, prefix + 'terms.npy'),
+            np.frombuffer('\n'.join(terms).encode('utf-8'), dtype=np.uint8))
+    if vectorizer.idf_ is not None:  # a CUIVectorizer counting CUIs has no IDF weights
+        np.save(os.path.join(path, prefix + 'idf.npy'), vectorizer.idf_)
+
+
+def restore_vocabulary(path, vectorizer, prefix=''):
+    """Makes an unfitted vectorizer equivalent to the one whose vocabulary was written to path"""
+    if isinstance(vectorizer, TextCUIVectorizer):
+        restore_vocabulary(path, vectorizer.text_vectorizer)
+        restore_vocabulary(path, vectorizer.cui_vectorizer, 'cui_')
+        return vectorizer
+    if isinstance(vectorizer, HashingTfidfVectorizer):
+        df = np.load(os.path.join(path, prefix + 'df.npy'))
+        return vectorizer.set_df(df[-1], np.load(os.path.join(path, prefix + 'df_indices.npy')), df[:-1])
+    terms = np.load(os.path.join(path, prefix + 'terms.npy')).tobytes().decode('utf-8')
+    terms = terms.split('\n') if terms else []
+    idf_path = os.path.join(path, prefix + 'idf.npy')
+    idf = np.load(idf_path) if os.path.exists(idf_path) else None
+    vectorizer.vocabulary_ = {t: i for i, t in enumerate(terms)}
+    if isinstance(vectorizer, CUIVectorizer):
+        vectorizer.idf_ = idf
+        return vectorizer
+    vectorizer.stop_words_ = set()
+    try:
+        vectorizer.idf_ = idf
+    except AttributeError:  # scikit-learn < 0.20 has no idf_ setter
+        vectorizer._tfidf._idf_diag = sp.spdiags(idf, diags=0, m=len(idf), n=len(idf), format='csr')
+    return vectorizer
+
+
+def save_matrix(path, X, name='X'):
+    X = X.tocsr()
+    for part in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(path, '%s_%s.npy' % (name, part)), getattr(X, part))
+
+
+def load_matrix(path, shape, name='X'):
+    """Returns the CSR matrix written by save_matrix, backed by memory-mapped arrays"""
+    data, indices, indptr = [np.load(os.path.join(path, '%s_%s.npy' % (name, part)), mmap_mode='r')
+                             for part in ('data', 'indices', 'indptr')]
+    return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def write_entry(cache_dir, key, write, manifest):
+    """
+    Creates the cache entry for key by calling write(path) and saving the manifest. The entry is written to a
+    temporary directory first so that readers never see a partial entry.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, 0o0755)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        write(tmp_path)
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_path, os.path.join(cache_dir, key))
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(os.path.join(cache_dir, key)):  # lost the race to a concurrent writer otherwise
+            raise
+
+
+def read_manifest(cache_dir, key):
+    """Returns the entry path and manifest for key, or (path, None) on a miss"""
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return path, None
+    with open(os.path.join(path, 'manifest.json')) as f:
+        return path, json.load(f)
+
+
+def save(cache_dir, key, vectorizer, study_ids, X, y):
+    """
+    Stores a fitted vectorizer, its document-term matrix and the corresponding NCTIds and labels under key
+    """
+    def write(path):
+        save_vocabulary(path, vectorizer)
+        save_matrix(path, X)
+        np.save(os.path.join(path, 'y.npy'), np.asarray(y))
+    write_entry(cache_dir, key, write, {'shape': list(X.shape), 'study_ids': list(study_ids)})
+
+
+def load(cache_dir, key, vectorizer):
+    """
+    Returns (study_ids, X, y) for a cached entry and restores its vocabulary into vectorizer, or None on a miss
+    """
+    path, manifest = read_manifest(cache_dir, key)
+    if manifest is None:
+        return None
+    restore_vocabulary(path, vectorizer)
+    X = load_matrix(path, tuple(manifest['shape']))
+    y = np.load(os.path.join(path, 'y.npy'))
+    return manifest['study_ids'], X, y
+
+
+def labels_key(key):
+    return key + '-labels'
+
+
+def save_labels(cache_dir, key, study_ids, y):
+    """Stores only the NCTIds and labels selected for key, for modes that vectorize each fold separately"""
+    write_entry(cache_dir, labels_key(key), lambda path: np.save(os.path.join(path, 'y.npy'), np.asarray(y)),
+                {'study_ids': list(study_ids)})
+
+
+def load_labels(cache_dir, key):
+    """Returns (study_ids, y) stored by save_labels, or None on a miss"""
+    path, manifest = read_manifest(cache_dir, labels_key(key))
+    if manifest is None:
+        return None
+    return manifest['study_ids'], np.load(os.path.join(path, 'y.npy'))
+
+
+def fold_key(key, seed, folds, fold_index, chi2_k):
+    """Returns the key of one cross-validation fold's fit of the data identified by key"""
+    return hashlib.sha1(json.dumps([key, seed, folds, fold_index, chi2_k]).encode('utf-8')).hexdigest()
+
+
+def has_entry(cache_dir, key):
+    return os.path.isdir(os.path.join(cache_dir, key))
+
+
+def save_fold(cache_dir, key, vectorizer, chi2_best, X_train, X_test):
+    """
+    Stores a vectorizer and chi2 selection fitted on one training fold and the selected training and test matrices
+    """
+    def write(path):
+        save_vocabulary(path, vectorizer)
+        np.save(os.path.join(path, 'chi2_scores.npy'), chi2_best.scores_)
+        np.save(os.path.join(path, 'chi2_pvalues.npy'), chi2_best.pvalues_)
+        save_matrix(path, X_train, 'X_train')
+        save_matrix(path, X_test, 'X_test')
+    write_entry(cache_dir, key, write, {'train_shape': list(X_train.shape), 'test_shape': list(X_test.shape)})
+
+
+def load_fold(cache_dir, key, vectorizer, chi2_best):
+    """
+    Returns (X_train, X_test) for a cached fold and restores the fitted state of vectorizer and chi2_best, or None on
+    a miss
+    """
+    path, manifest = read_manifest(cache_dir, key)
+    if manifest is None:
+        return None
+    restore_vocabulary(path, vectorizer)
+    chi2_best.scores_ = np.load(os.path.join(path, 'chi2_scores.npy'))
+    chi2_best.pvalues_ = np.load(os.path.join(path, 'chi2_pvalues.npy'))
+    return (load_matrix(path, tuple(manifest['train_shape']), 'X_train'),
+            load_matrix(path, tuple(manifest['test_shape']), 'X_test'))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Fixed-width hashed n-gram features with a separate IDF weighting step, for corpora too large for a vocabulary dict
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+
+def make_hashing_vectorizer(n_features):
+    """Returns a HashingVectorizer producing raw, non-negative unigram and bigram counts"""
+    params = dict(ngram_range=(1, 2), n_features=n_features, norm=None)
+    try:
+        return HashingVectorizer(alternate_sign=False, **params)
+    except TypeError:  # scikit-learn < 0.19
+        return HashingVectorizer(non_negative=True, **params)
+
+
+class HashingTfidfVectorizer(object):
+    """
+    Equivalent of TfidfVectorizer(ngram_range=(1, 2)) whose n-grams are hashed into n_features columns instead of
+    being kept in a vocabulary. Fitting only records the document frequencies of the columns that occur, so the
+    fitted state and the pickled size grow with the number of distinct hashed n-grams, not with a dict of strings.
+    IDF weights are smoothed and rows L2-normalized as in TfidfVectorizer.
+    """
+
+    def __init__(self, n_features=2 ** 20):
+        super().__init__()
+        self.n_features = n_features
+        self.hashing_vectorizer = make_hashing_vectorizer(n_features)
+
+    def get_params(self, deep=True):
+        return {'n_features': self.n_features}
+
+    def set_df(self, n_docs, df_indices, df):
+        """
+        Sets the fitted state: the number of training documents, and the sorted columns seen in training with their
+        document frequencies
+        """
+        self.n_docs_ = int(n_docs)
+        self.df_indices_ = np.asarray(df_indices, dtype=np.int32)
+        self.df_ = np.asarray(df, dtype=np.uint32)
+        return self
+
+    def idf(self, columns):
+        """Returns the IDF weights of the given columns; columns never seen in training get the highest weight"""
+        df = np.zeros(len(columns))
+        if len(self.df_indices_):
+            pos = np.minimum(np.searchsorted(self.df_indices_, columns), len(self.df_indices_) - 1)
+            seen = self.df_indices_[pos] == columns
+            df[seen] = self.df_[pos[seen]]
+        return np.log((1 + self.n_docs_) / (1 + df)) + 1
+
+    def count(self, docs):
+        X = self.hashing_vectorizer.transform(docs).tocsr()
+        X.sum_duplicates()
+        return X
+
+    def weight(self, X):
+        X.data *= self.idf(X.indices)
+        return normalize(X, norm='l2', copy=False)
+
+    def fit_transform(self, docs):
+        X = self.count(docs)
+        df_indices, df = np.unique(X.indices, return_counts=True)
+        self.set_df(X.shape[0], df_indices, df)
+        return self.weight(X)
+
+    def fit(self, docs):
+        self.fit_transform(docs)
+        return self
+
+    def transform(self, docs):
+        return self.weight(self.count(docs))
+
+    def get_feature_names(self):
+        """Hashed columns have no names; they are named after their column index"""
+        return ['hash:%d' % i for i in range(self.n_features)]
+
+
+class ColumnSelection(object):
+    """
+    The columns picked by a fitted feature selector such as SelectKBest, without its per-column scores, which over a
+    hashed feature space take up most of an exported model
+    """
+
+    def __init__(self, selector):
+        super().__init__()
+        support = selector.get_support()
+        self.n_features = len(support)
+        self.columns = np.flatnonzero(support).astype(np.int32)
+
+    def get_support(self, indices=False):
+        if indices:
+            return self.columns
+        mask = np.zeros(self.n_features, dtype=bool)
+        mask[self.columns] = True
+        return mask
+
+    def transform(self, X):
+        return X.tocsr()[:, self.columns]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Linear SVM scorer compiled from a compact model into a lookup table, scoring each text in one pass without sklearn
+
+from collections import Counter
+import functools
+import math
+
+import numpy as np
+
+import model_artifact
+
+
+class LinearScorer(object):
+    """
+    Scores texts with the model described by a compact model manifest and arrays (see model_artifact.py). The
+    coefficients of the selected features, multiplied by their IDF weights, are compiled into a dict keyed by feature
+    key, while the IDF weights of all features stay in the sorted (memory-mapped) key and IDF arrays. A text is
+    tokenized once, its norm is computed from one lookup of its distinct keys in those arrays, and its decision values
+    are accumulated over the keys found in the dict, giving the same results as the vectorizer, chi2 selection and
+    LinearSVC.
+    """
+
+    def __init__(self, manifest, arrays):
+        super().__init__()
+        self.classes = manifest['classes']
+        self.unseen_idf = manifest['unseen_idf']
+        self.analyze = model_artifact.make_analyzer(manifest['ngram_range'], manifest['lowercase'],
+                                                    manifest['token_pattern'])
+        # memoizes the keys of common n-grams
+        self.key = functools.lru_cache(maxsize=model_artifact.KEY_CACHE_SIZE)(model_artifact.make_key(manifest))
+        self.keys = arrays['keys']
+        self.idf = arrays['idf']
+        selected_keys = np.asarray(arrays['selected_keys'])
+        weights = self.idf_weights(selected_keys)
+        self.table = {key: tuple(weight * c for c in coef)
+                      for key, weight, coef in zip(selected_keys.tolist(), weights.tolist(), arrays['coef'].T.tolist())}
+        self.intercept = arrays['intercept'].tolist()
+        self.binary = len(self.intercept) == 1
+
+    def idf_weights(self, keys):
+        """
+        Returns the IDF weights of an array of keys. Keys a vocabulary wasn't fitted on get 0, since they are ignored.
+        """
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, self.idf[pos], self.unseen_idf or 0.0)
+
+    def decision_value(self, text):
+        """Returns the decision function value of one text: a float for binary models, one per class otherwise"""
+        counts = Counter(map(self.key, self.analyze(text)))  # n-grams hashed to the same column add up
+        keys = np.fromiter(counts, dtype=np.uint64, count=len(counts))
+        tf = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        weights = tf * self.idf_weights(keys)
+        norm = math.sqrt(np.dot(weights, weights))
+        if norm == 0:
+            scores = list(self.intercept)
+        else:
+            scores = [0.0] * len(self.intercept)
+            for key, n in counts.items():
+                coef = self.table.get(key)
+                if coef is not None:
+                    for i, c in enumerate(coef):
+                        scores[i] += n * c
+            scores = [s / norm + b for s, b in zip(scores, self.intercept)]
+        return scores[0] if self.binary else scores
+
+    def label(self, value):
+        if self.binary:
+            return self.classes[1 if value > 0 else 0]
+        return self.classes[value.index(max(value))]
+
+    def decision_function(self, texts):
+        return [self.decision_value(text) for text in texts]
+
+    def predict(self, texts):
+        return [self.label(self.decision_value(text)) for text in texts]
+
+    def score(self, texts):
+        """Returns the predicted labels and decision function values of texts"""
+        values = self.decision_function(texts)
+        return [self.label(v) for v in values], values
+
+
+def from_model(model):
+    """
+    Returns a LinearScorer for a model loaded with model_artifact.load(), sharing the memory-mapped arrays of a compact
+    model
+    """
+    if isinstance(model, model_artifact.CompactModel):
+        return LinearScorer(model.manifest, model.arrays)
+    payload = model.payload
+    return LinearScorer(*model_artifact.compact(payload['vectorizer'], payload['chi2_best'], payload['model']))
+
+
+def load(path):
+    """Returns a LinearScorer for the compact model directory or pickled payload exported by ml_classify.py to path"""
+    return from_model(model_artifact.load(path))
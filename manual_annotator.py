@@ -2,16 +2,16 @@
 
 import argparse
 import os
-import re
 import requests
 import sqlite3
-import string
-import subprocess
 import sys
 import webbrowser
 from time import sleep
 import xml.etree.ElementTree as ET
 
+from segment import split_sentences
+from transliterate import to_ascii
+
 API_URL = "https://clinicaltrials.gov/ct2/show/%s?displayxml=true"
 
 
@@ -111,21 +111,10 @@ class Database(object):
                 lines = [title + '.']
                 for l in condition.split('\n'):
                     lines.append(l + '.')
-            segments = re.split(
-                r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
-                ec, flags=re.MULTILINE)
-            for i, l in enumerate(segments):
-                l = l.strip()
-                if l:
-                    if l:
-                        if ' ' in l and l[-1] not in string.punctuation:
-                            l += '.'
-                        lines.append(l)
+            lines.extend(split_sentences(ec))
             text = '\n'.join(lines)
         if print_ascii:
-            cp = subprocess.run(['iconv', '-t', 'ascii//TRANSLIT'], input=text, stdout=subprocess.PIPE,
-                                universal_newlines=True)
-            text = cp.stdout
+            text = to_ascii(text)
         print(text)
 
 
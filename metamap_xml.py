@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# Streaming reader for MetaMap XML output (metamap --XMLf)
+
+from collections import namedtuple
+import xml.etree.ElementTree as ET
+
+# semantic types whose concepts are kept as CUI features
+SEMANTIC_TYPES = {'aapp', 'dsyn', 'fndg', 'lbpr', 'lbtr', 'moft', 'phsu', 'topp', 'virs'}
+
+Candidate = namedtuple('Candidate', ('cui', 'preferred', 'sem_types', 'negated'))
+Mapping = namedtuple('Mapping', ('score', 'candidates'))
+
+
+def parse_mapping(mapping):
+    candidates = []
+    for candidate in mapping.iter('Candidate'):
+        negated = candidate.findtext('Negated')
+        candidates.append(Candidate(
+            candidate.findtext('CandidateCUI'),
+            candidate.findtext('CandidatePreferred'),
+            frozenset(st.text for st in candidate.iter('SemType')),
+            negated is not None and int(negated) == 1))
+    score = mapping.findtext('MappingScore')
+    return Mapping(int(score) if score is not None else None, candidates)
+
+
+def iter_phrase_mappings(filename):
+    """
+    Yields the list of Mappings of every Phrase in a MetaMap XML file, in document order. The file is parsed
+    incrementally and each phrase is discarded once it has been processed, so memory use does not grow with the
+    size of the file.
+    """
+    with open(filename, 'rb') as f:
+        f.readline()  # workaround for non-XML first line
+        for event, elem in ET.iterparse(f, events=('end',)):
+            if elem.tag == 'Phrase':
+                yield [parse_mapping(mapping) for mapping in elem.iter('Mapping')]
+                elem.clear()
+            elif elem.tag == 'Utterance':
+                elem.clear()
@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 
 import json
+import multiprocessing
 import pickle
 import pprint
-import re
 import sqlite3
-import string
 import sys
 
 
@@ -19,59 +18,45 @@ from sklearn import cross_validation
 from scipy import stats as ST
 import matplotlib.pyplot as plt
 
-REMOVE_PUNC = str.maketrans({key: None for key in string.punctuation})
+import feature_cache
+from cui_features import CUIVectorizer, TextCUIVectorizer
+from cui_store import load_cuis
+from hashing_features import ColumnSelection, HashingTfidfVectorizer
+import model_artifact
+from study_text import filtered_texts
 
 
-def filter_study(ec):
-    """take one study and returns a filtered version with only relevant lines included"""
-    lines = []
-    segments = re.split(
-        r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
-        ec, flags=re.MULTILINE)
-    for i, l in enumerate(segments):
-        l = l.strip()
-        if l:
-            l = l.translate(REMOVE_PUNC).strip()
-            if l:
-                lines.append(l)
-    return '\n'.join(lines)
-
-
-def vectorize_all(vectorizer, input_docs, fit=False):
-    if fit:
-        dtm = vectorizer.fit_transform(input_docs)
-    else:
-        dtm = vectorizer.transform(input_docs)
-    return dtm
-
-
-if __name__ == '__main__':
-
-    np.set_printoptions(precision=2)
-
-    with open(sys.argv[1]) as f:
-        config = json.load(f)
-    pp = pprint.PrettyPrinter(indent=4)
-    pp.pprint(config)
-    if config.get('cui_file'):
-        CUI = json.load(open(config['cui_file']))
-    else:
-        CUI = None
-
+def load_documents(config):
+    """
+    Returns the NCTIds, filtered texts and labels of the annotated studies selected by the config. With
+    "cui_features", each document is a (text, CUI lines) pair instead.
+    """
     conn = sqlite3.connect(config['database'])
     c = conn.cursor()
     c.execute('SELECT studies.NCTId, studies.EligibilityCriteria, annotations.%s \
         FROM studies, annotations WHERE studies.NCTId=annotations.NCTId \
         AND annotations.%s IS NOT NULL ORDER BY studies.NCTId' % (config['annotation'], config['annotation']))
+    rows = c.fetchall()
+    texts = filtered_texts(conn, [(row[0], row[1]) for row in rows])
+
+    if config.get('cui_file'):
+        CUI = load_cuis(config['cui_file'], [row[0] for row in rows])
+    else:
+        CUI = None
 
     X = []
     y = []
     study_ids = []
 
-    for row in c.fetchall():
-        text = filter_study(row[1])
+    for row, text in zip(rows, texts):
+        if not text:
+            print("[WARNING] no text returned from %s after filtering" % row[0])
         if CUI is not None:
-            text += '\n' + '\n'.join(CUI[row[0]])
+            if config.get('cui_features'):
+                # the CUIs are vectorized separately by make_vectorizer(); a study without text or CUIs is dropped
+                text = (text, CUI[row[0]]) if text or CUI[row[0]] else None
+            else:
+                text += '\n' + '\n'.join(CUI[row[0]])
         # print(text)
         if text:
             yv = row[2]
@@ -82,34 +67,253 @@ if __name__ == '__main__':
             X.append(text)
             y.append(yv)
             study_ids.append(row[0])
-        else:
-            print("[WARNING] no text returned from %s after filtering" % row[0])
+    conn.close()
+    return study_ids, X, y
+
+
+def make_vectorizer(config):
+    """
+    Returns the unfitted vectorizer selected by the config. With "cui_features" set to "count" or "tfidf", the CUIs
+    get their own integer-coded columns next to the text n-grams. With "hashing_features" set to a number of columns,
+    the n-grams are hashed into that many columns instead of being kept in a vocabulary.
+    """
+    if config.get('hashing_features'):
+        vectorizer = HashingTfidfVectorizer(config['hashing_features'])
+    else:
+        vectorizer = TfidfVectorizer(ngram_range=(1, 2))
+    if config.get('cui_file') and config.get('cui_features'):
+        vectorizer = TextCUIVectorizer(vectorizer, CUIVectorizer(config['cui_features']))
+    return vectorizer
 
-    study_ids = np.array(study_ids)
 
+def vectorize_all(vectorizer, input_docs, fit=False):
+    if fit:
+        dtm = vectorizer.fit_transform(input_docs)
+    else:
+        dtm = vectorizer.transform(input_docs)
+    return dtm
+
+
+def load_features(config):
+    """
+    Returns the NCTIds, document-term matrix and labels of the selected studies, along with the vectorizer and the
+    imported model, if any
+    """
     model = None
     if config.get('model'):
         with open(config['model'], 'rb') as f:
             payload = pickle.load(f)
             vectorizer = payload['vectorizer']
             model = payload['model']
+        study_ids, X, y = load_documents(config)
         X = vectorize_all(vectorizer, X, fit=False)
     else:
-        vectorizer = TfidfVectorizer(ngram_range=(1, 2))
-        X = vectorize_all(vectorizer, X, fit=True)
+        vectorizer = make_vectorizer(config)
+        cached = None
+        if config.get('cache_dir'):
+            cache_key = feature_cache.cache_key(config, vectorizer)
+            cached = feature_cache.load(config['cache_dir'], cache_key, vectorizer)
+        if cached is not None:
+            study_ids, X, y = cached
+            print("Loaded features from cache " + cache_key)
+        else:
+            study_ids, X, y = load_documents(config)
+            X = vectorize_all(vectorizer, X, fit=True)
+            if config.get('cache_dir'):
+                feature_cache.save(config['cache_dir'], cache_key, vectorizer, study_ids, X, y)
+    return study_ids, X, y, vectorizer, model
+
+
+def build_model(config, seed):
+    config_svm = config.get('svm', {})
+    class_weight = config_svm.get('class_weight', None)
+    if class_weight is not None and class_weight != 'balanced':
+        class_weight = dict(zip(range(len(class_weight)), class_weight))
+    return svm.LinearSVC(
+        C=config_svm.get('C', 1),
+        class_weight=class_weight,
+        random_state=seed)
+
+
+def evaluate_fold(y_test, y_predicted, y_predicted_score, label_map):
+    """
+    Returns the per-fold statistics of one cross-validation fold: per-label precision, recall, F2, ROC-AUC and
+    PR-AUC, the averaged precision, recall and F2, and the per-label curve inputs that are accumulated across folds
+    """
+    if len(label_map) > 2:
+        avg_mode = 'macro'
+    else:
+        avg_mode = 'binary'
+
+    sd = list(metrics.precision_recall_fscore_support(y_test, y_predicted, beta=2.0, average=None))[:3]
+    aucs = []
+    ap_score = []
+    y_test_class = []
+    y_pred_class = []
+    tprs = []
+    for i, label in enumerate(label_map):
+        bt = (y_test == i)
+        y_test_class.append(list(bt))
+        if len(label_map) > 2:
+            bp = y_predicted_score[:,i]
+            y_pred_class.append(list(bp))
+        else:
+            if i == 0:
+                bp = [-x for x in y_predicted_score]
+            else:
+                bp = [x for x in y_predicted_score]
+            y_pred_class.append(bp)
 
-    y = np.array(y)
-    print(X.shape)
+        aucs.append(metrics.roc_auc_score(bt, bp))
+        fpr, tpr, thresholds = metrics.roc_curve(bt, bp)
+        tprs.append(np.interp(np.linspace(0, 1, 100), fpr, tpr))
 
+        ap_score.append(metrics.average_precision_score(bt, bp))
+
+    sd.append(np.array(aucs))
+    sd.append(np.array(ap_score))
+
+    # compute micro-averaged stats
+    global_sd = list(metrics.precision_recall_fscore_support(
+        y_test, y_predicted, beta=2.0, average=avg_mode))[:3]
+
+    return {
+        'stats': sd,
+        'global_stats': global_sd,
+        'f2': metrics.fbeta_score(y_test, y_predicted, beta=2.0, average=avg_mode),
+        'y_test_class': y_test_class,
+        'y_pred_class': y_pred_class,
+        'tpr': tprs,
+    }
+
+
+def confidence_interval(sd):
+    """Returns the 95% confidence interval of the mean of per-fold values"""
+    return np.array(ST.t.interval(0.95, len(sd) - 1, loc=np.mean(sd), scale=ST.sem(sd)))
+
+
+_fold_state = {}
+
+
+def init_fold_worker(X, y, config, model, seed, texts=None, fold_keys=None):
+    """
+    Makes the data shared by all folds available to run_fold(). Pool workers receive it once at startup (inherited
+    on fork) instead of with every fold.
+    """
+    _fold_state.update(X=X, y=y, config=config, model=model, seed=seed, texts=texts, fold_keys=fold_keys)
+
+
+def vectorize_fold(vectorizer, texts, train, test):
+    """Fits vectorizer on the training fold of texts and returns the training and test document-term matrices"""
+    X_train = vectorize_all(vectorizer, [texts[i] for i in train], fit=True)
+    X_test = vectorize_all(vectorizer, [texts[i] for i in test], fit=False)
+    return X_train, X_test
+
+
+def featurize_fold(fold_index, train, test):
+    """
+    Fits the vectorizer and chi2 selection on the training fold only, so that no test labels leak into feature
+    selection. Returns them with the selected training and test matrices. Fits are cached per fold when
+    "cache_dir" is set.
+    """
+    y, config = _fold_state['y'], _fold_state['config']
+    vectorizer = make_vectorizer(config)
     chi2_best = SelectKBest(chi2, k=config.get('chi2_k', 250))
-    X = chi2_best.fit_transform(X, y)
-    print(X.shape)
-    print(np.asarray(vectorizer.get_feature_names())[chi2_best.get_support()])
+    if config.get('cache_dir'):
+        key = _fold_state['fold_keys'][fold_index]
+        cached = feature_cache.load_fold(config['cache_dir'], key, vectorizer, chi2_best)
+        if cached is not None:
+            return (vectorizer, chi2_best) + cached
+
+    X_train, X_test = vectorize_fold(vectorizer, _fold_state['texts'], train, test)
+    X_train = chi2_best.fit_transform(X_train, y[train])
+    X_test = chi2_best.transform(X_test)
+    if config.get('cache_dir'):
+        feature_cache.save_fold(config['cache_dir'], key, vectorizer, chi2_best, X_train, X_test)
+    return vectorizer, chi2_best, X_train, X_test
+
+
+def run_fold(fold):
+    """
+    Fits (unless a model was imported) and evaluates one cross-validation fold
+    """
+    fold_index, train, test = fold
+    X, y, config = _fold_state['X'], _fold_state['y'], _fold_state['config']
+    vectorizer = chi2_best = None
+    if X is None:
+        vectorizer, chi2_best, X_train, X_test = featurize_fold(fold_index, train, test)
+    else:
+        X_train, X_test = X[train], X[test]
+    y_train, y_test = y[train], y[test]
+
+    model = _fold_state['model']
+    if model is None:
+        model = build_model(config, _fold_state['seed'])
+        model.fit(X_train, y_train)
+
+    y_predicted = model.predict(X_test)
+    y_predicted_score = model.decision_function(X_test)
+
+    result = evaluate_fold(y_test, y_predicted, y_predicted_score, config['labels'])
+    result.update(test=test, model=model, vectorizer=vectorizer, chi2_best=chi2_best,
+                  y_predicted=y_predicted, y_predicted_score=y_predicted_score)
+    return result
+
+
+if __name__ == '__main__':
+
+    np.set_printoptions(precision=2)
+
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+    if (config.get('export') and config.get('export_format') == 'compact' and config.get('cui_file') and
+            config.get('cui_features')):
+        sys.exit('"export_format": "compact" does not support "cui_features", export a pickle instead')
+    pp = pprint.PrettyPrinter(indent=4)
+    pp.pprint(config)
 
-    stats = []
-    global_stats = []
     seed = 0
     folds = 10
+
+    texts = None
+    fold_keys = None
+    if config.get('fold_local') and not config.get('model'):
+        # vectorize and select features inside each training fold instead of on the full data set
+        print("Fitting vectorizer and chi2 selection per fold")
+        X = vectorizer = chi2_best = model = None
+        cached = None
+        if config.get('cache_dir'):
+            cache_key = feature_cache.cache_key(config, make_vectorizer(config))
+            fold_keys = [feature_cache.fold_key(cache_key, seed, folds, i, config.get('chi2_k', 250))
+                         for i in range(folds)]
+            if all(feature_cache.has_entry(config['cache_dir'], k) for k in fold_keys):
+                cached = feature_cache.load_labels(config['cache_dir'], cache_key)
+        if cached is not None:
+            study_ids, y = cached
+        else:
+            study_ids, texts, y = load_documents(config)
+            if config.get('cache_dir'):
+                feature_cache.save_labels(config['cache_dir'], cache_key, study_ids, y)
+        study_ids = np.array(study_ids)
+        y = np.array(y)
+    else:
+        study_ids, X, y, vectorizer, model = load_features(config)
+
+        study_ids = np.array(study_ids)
+        y = np.array(y)
+        print(X.shape)
+
+        chi2_best = SelectKBest(chi2, k=config.get('chi2_k', 250))
+        X = chi2_best.fit_transform(X, y)
+        print(X.shape)
+        columns = chi2_best.get_support(indices=True)
+        if isinstance(vectorizer, HashingTfidfVectorizer):  # name only the selected columns, not all n_features
+            print(np.asarray(['hash:%d' % i for i in columns]))
+        else:
+            print(np.asarray(vectorizer.get_feature_names())[columns])
+
+    stats = []
+    global_stats = []
     print("CV folds: %s" % folds)
 
     label_map = config['labels']
@@ -129,35 +333,35 @@ if __name__ == '__main__':
     y_pred_proba_all = []
 
     skf = cross_validation.StratifiedKFold(y, n_folds=folds, shuffle=True, random_state=seed)
+    fold_tasks = [(i, train, test) for i, (train, test) in enumerate(skf)]
+    n_jobs = config.get('n_jobs', 1)
+    if n_jobs > 1:
+        with multiprocessing.Pool(n_jobs, initializer=init_fold_worker,
+                                  initargs=(X, y, config, model, seed, texts, fold_keys)) as pool:
+            fold_results = pool.map(run_fold, fold_tasks, 1)
+    else:
+        init_fold_worker(X, y, config, model, seed, texts, fold_keys)
+        fold_results = map(run_fold, fold_tasks)
+
+    # merge the folds in order, so the output is the same however many jobs were used
     model_cache = []
-    for train, test in skf:
-        X_train, X_test, y_train, y_test = X[train], X[test], y[train], y[test]
+    for fold_result in fold_results:
+        test = fold_result['test']
+        y_test = y[test]
         y_test_all.extend(y_test)
         study_ids_test.extend(list(study_ids[test]))
 
-        if not config.get('model'):
-            config_svm = config.get('svm', {})
-            class_weight = config_svm.get('class_weight', None)
-            if class_weight != 'balanced':
-                class_weight = dict(zip(range(len(class_weight)), class_weight))
-            model = svm.LinearSVC(
-                C=config_svm.get('C', 1),
-                class_weight=class_weight,
-                random_state=seed)
-            model.fit(X_train, y_train)
-
-        y_predicted = model.predict(X_test)
+        y_predicted = fold_result['y_predicted']
         y_pred_all.extend(y_predicted)
 
-        if len(label_map) > 2:
-            avg_mode = 'macro'
-        else:
-            avg_mode = 'binary'
-
         if config.get('export'):
-            model_cache.append((model, metrics.fbeta_score(y_test, y_predicted, beta=2.0, average=avg_mode)))
+            if X is None:  # fold-local mode exports the vectorizer and selection fitted with the model
+                model_cache.append((fold_result['model'], fold_result['f2'],
+                                    fold_result['vectorizer'], fold_result['chi2_best']))
+            else:
+                model_cache.append((fold_result['model'], fold_result['f2'], vectorizer, chi2_best))
 
-        y_predicted_score = model.decision_function(X_test)
+        y_predicted_score = fold_result['y_predicted_score']
         prob_min = y_predicted_score.min()
         prob_max = y_predicted_score.max()
         for x in y_predicted_score:
@@ -168,37 +372,14 @@ if __name__ == '__main__':
                 p = (x - prob_min) / (prob_max - prob_min)
                 y_pred_proba_all.append((1 - p, p))
 
-        sd = list(metrics.precision_recall_fscore_support(y_test, y_predicted, beta=2.0, average=None))[:3]
-        aucs = []
-        ap_score = []
         for i, label in enumerate(label_map):
-            bt = (y_test == i)
-            y_test_class[label].extend(list(bt))
-            if len(label_map) > 2:
-                bp = y_predicted_score[:,i]
-                y_pred_class[label].extend(list(bp))
-            else:
-                if i == 0:
-                    bp = [-x for x in y_predicted_score]
-                else:
-                    bp = [x for x in y_predicted_score]
-                y_pred_class[label].extend(bp)
-
-            aucs.append(metrics.roc_auc_score(bt, bp))
-            fpr, tpr, thresholds = metrics.roc_curve(bt, bp)
-            mean_tpr[label] += np.interp(mean_fpr[label], fpr, tpr)
+            y_test_class[label].extend(fold_result['y_test_class'][i])
+            y_pred_class[label].extend(fold_result['y_pred_class'][i])
+            mean_tpr[label] += fold_result['tpr'][i]
             mean_tpr[label][0] = 0.0
 
-            ap_score.append(metrics.average_precision_score(bt, bp))
-
-        sd.append(np.array(aucs))
-        sd.append(np.array(ap_score))
-        stats.append(sd)
-
-        # compute micro-averaged stats
-        global_sd = list(metrics.precision_recall_fscore_support(
-            y_test, y_predicted, beta=2.0, average=avg_mode))[:3]
-        global_stats.append(global_sd)
+        stats.append(fold_result['stats'])
+        global_stats.append(fold_result['global_stats'])
 
     y_pred_proba_all = np.array(y_pred_proba_all)
 
@@ -216,7 +397,7 @@ if __name__ == '__main__':
             print("%s %s: %s" % (label, metric, sd))
             sd_mean = np.mean(sd)
             stat_mean[metric] = sd_mean
-            sd_ci = np.array(ST.t.interval(0.95, len(sd) - 1, loc=sd_mean, scale=ST.sem(sd)))
+            sd_ci = confidence_interval(sd)
             print("%s %s: %.2f %s" % (label, metric, sd_mean, sd_ci))
         print("%s count: %s" % (label, len([x for x in y_test_all if x == i])))
 
@@ -238,7 +419,7 @@ if __name__ == '__main__':
         print("All %s: %s" % (metric, sd))
         sd_mean = np.mean(sd)
         stat_mean[metric] = sd_mean
-        sd_ci = np.array(ST.t.interval(0.95, len(sd) - 1, loc=sd_mean, scale=ST.sem(sd)))
+        sd_ci = confidence_interval(sd)
         print("All %s: %.2f %s" % (metric, sd_mean, sd_ci))
 
 
@@ -247,13 +428,19 @@ if __name__ == '__main__':
 
     if config.get('export'):
         model_cache.sort(key=lambda x: x[1], reverse=True)  # sort by descending F-score
-        payload = {
-            'vectorizer': vectorizer,
-            'model': model_cache[0][0],
-            'chi2_best': chi2_best
-        }
-        with open(config['export'], 'wb') as f:
-            pickle.dump(payload, f)
+        chi2_best = model_cache[0][3]
+        if config.get('export_format') == 'compact':
+            model_artifact.save(config['export'], model_cache[0][2], chi2_best, model_cache[0][0])
+        else:
+            if config.get('hashing_features'):
+                chi2_best = ColumnSelection(chi2_best)  # drop the chi2 scores of every hashed column
+            payload = {
+                'vectorizer': model_cache[0][2],
+                'model': model_cache[0][0],
+                'chi2_best': chi2_best
+            }
+            with open(config['export'], 'wb') as f:
+                pickle.dump(payload, f)
         print("Exported vectorizer and model to " + config['export'])
 
     plt.figure(1)
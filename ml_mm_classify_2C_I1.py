@@ -1,10 +1,7 @@
 #!/usr/bin/env python3
 # Binary classifier - combine classes 1 (indeterminate) and 2 (HIV-eligible)
 
-import pickle
-import re
 import sqlite3
-import string
 import sys
 
 
@@ -18,24 +15,19 @@ from sklearn import cross_validation
 from scipy import stats as ST
 import matplotlib.pyplot as plt
 
+import segment
+from cui_store import load_cuis
+
 DATABASE = 'studies.sqlite'
 CUI_PATH = 'cuis.pickle'
 
-REMOVE_PUNC = str.maketrans({key: None for key in string.punctuation})
-
 
 def filter_study(title, condition, ec):
     """take one study and returns a filtered version with only relevant lines included"""
     lines = [title, condition]
-    segments = re.split(
-        r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
-        ec, flags=re.MULTILINE)
-    for i, l in enumerate(segments):
-        l = l.strip()
-        if l:
-            l = l.translate(REMOVE_PUNC).strip()
-            if l:
-                lines.append(l)
+    ec = segment.filter_study(ec)
+    if ec:
+        lines.append(ec)
     return '\n'.join(lines)
 
 
@@ -53,15 +45,15 @@ if __name__ == '__main__':
     study_ids = []
     actual_labels = []
 
-    CUI = pickle.load(open(CUI_PATH, 'rb'))
-
     conn = sqlite3.connect(DATABASE)
     c = conn.cursor()
     c.execute("SELECT t1.NCTId, t1.BriefTitle, t1.Condition, t1.EligibilityCriteria, t2.hiv_eligible \
         FROM studies AS t1, hiv_status AS t2 WHERE t1.NCTId=t2.NCTId AND t1.StudyType LIKE '%Interventional%' \
         ORDER BY t1.NCTId")
+    rows = c.fetchall()
+    CUI = load_cuis(CUI_PATH, [row[0] for row in rows])
 
-    for row in c.fetchall():
+    for row in rows:
         text = filter_study(row[1], row[2], row[3]) + '\n' + '\n'.join(CUI[row[0]])
         if text:
             yv = row[4]
@@ -1,10 +1,7 @@
 #!/usr/bin/env python3
 # Binary classifier - combine classes 1 (indeterminate) and 2 (HIV-eligible)
 
-import pickle
-import re
 import sqlite3
-import string
 import sys
 
 
@@ -18,25 +15,20 @@ from sklearn import cross_validation
 from scipy import stats as ST
 import matplotlib.pyplot as plt
 
+import segment
+from cui_store import load_cuis
+
 DATABASE = 'studies.sqlite'
 CUI_PATH = 'cuis_I.pickle'
 STUDY_FILE_PATH = 'mentions_hiv.txt'
 
-REMOVE_PUNC = str.maketrans({key: None for key in string.punctuation})
-
 
 def filter_study(title, condition, ec):
     """take one study and returns a filtered version with only relevant lines included"""
     lines = [title, condition]
-    segments = re.split(
-        r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
-        ec, flags=re.MULTILINE)
-    for i, l in enumerate(segments):
-        l = l.strip()
-        if l:
-            l = l.translate(REMOVE_PUNC).strip()
-            if l:
-                lines.append(l)
+    ec = segment.filter_study(ec)
+    if ec:
+        lines.append(ec)
     return '\n'.join(lines)
 
 
@@ -56,7 +48,7 @@ if __name__ == '__main__':
     sf = open(STUDY_FILE_PATH, 'r')
     sf_sids = [l.strip() for l in sf if l.strip()]
 
-    CUI = pickle.load(open(CUI_PATH, 'rb'))
+    CUI = load_cuis(CUI_PATH, sf_sids)
 
     conn = sqlite3.connect(DATABASE)
     c = conn.cursor()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Hyperparameter sweep over svm.C, svm.class_weight and chi2_k for an ml_classify.py configuration.
+# Features are built the way ml_classify.py builds them for the configuration: the studies are vectorized and chi2
+# scores computed once on the full data set, or with "fold_local" once per training fold. The scores are reused for
+# every k, and the models for all parameter combinations are fit in parallel.
+
+import itertools
+import json
+import multiprocessing
+import pprint
+import sys
+
+import numpy as np
+from sklearn.feature_selection import chi2
+from sklearn import cross_validation
+
+from ml_classify import (build_model, confidence_interval, evaluate_fold, load_documents, load_features,
+                         make_vectorizer, vectorize_fold)
+
+
+def select_k_best(scores, k):
+    """Returns the sorted column indices SelectKBest(chi2, k) would keep for the given chi2 scores"""
+    scores = np.array(scores, dtype=np.float64)
+    scores[np.isnan(scores)] = np.finfo(scores.dtype).min
+    return np.sort(np.argsort(scores, kind='mergesort')[-k:])
+
+
+_sweep_state = {}
+
+
+def init_sweep_worker(X, y, folds, fold_scores, config, seed, fold_matrices=None):
+    """
+    Makes the data shared by all fits available to run_fit(), once per worker process. fold_matrices holds the
+    (X_train, X_test) matrices vectorized per fold when X is None.
+    """
+    _sweep_state.update(X=X, y=y, folds=folds, fold_scores=fold_scores, config=config, seed=seed,
+                        fold_matrices=fold_matrices)
+
+
+def run_fit(params):
+    """
+    Fits and evaluates one fold for one (fold, chi2_k, C, class_weight) combination
+    """
+    fold_index, k, C, class_weight = params
+    X, y, config = _sweep_state['X'], _sweep_state['y'], _sweep_state['config']
+    train, test = _sweep_state['folds'][fold_index]
+    columns = select_k_best(_sweep_state['fold_scores'][fold_index], k)
+    if X is None:
+        X_train, X_test = _sweep_state['fold_matrices'][fold_index]
+    else:
+        X_train, X_test = X[train], X[test]
+    X_train, X_test, y_train, y_test = X_train[:, columns], X_test[:, columns], y[train], y[test]
+
+    model = build_model(dict(config, svm={'C': C, 'class_weight': class_weight}), _sweep_state['seed'])
+    model.fit(X_train, y_train)
+    y_predicted = model.predict(X_test)
+    y_predicted_score = model.decision_function(X_test)
+    result = evaluate_fold(y_test, y_predicted, y_predicted_score, config['labels'])
+    return result['stats'], result['global_stats']
+
+
+if __name__ == '__main__':
+
+    np.set_printoptions(precision=2)
+
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+    pp = pprint.PrettyPrinter(indent=4)
+    pp.pprint(config)
+
+    config_svm = config.get('svm', {})
+    grid = config.get('sweep', {})
+    grid_k = grid.get('chi2_k', [config.get('chi2_k', 250)])
+    grid_C = grid.get('C', [config_svm.get('C', 1)])
+    grid_class_weight = grid.get('class_weight', [config_svm.get('class_weight', None)])
+
+    seed = 0
+    folds = 10
+    fold_matrices = None
+    if config.get('fold_local'):
+        # as in ml_classify.py, no test fold contributes to the vocabulary, IDF weights or chi2 scores
+        print("Fitting vectorizer and chi2 scores per fold")
+        X = None
+        study_ids, texts, y = load_documents(config)
+        y = np.array(y)
+        skf = list(cross_validation.StratifiedKFold(y, n_folds=folds, shuffle=True, random_state=seed))
+        fold_matrices = [vectorize_fold(make_vectorizer(config), texts, train, test) for train, test in skf]
+        fold_scores = [chi2(X_train, y[train])[0] for (X_train, X_test), (train, test) in zip(fold_matrices, skf)]
+    else:
+        study_ids, X, y, vectorizer, model = load_features(config)
+        y = np.array(y)
+        print(X.shape)
+        skf = list(cross_validation.StratifiedKFold(y, n_folds=folds, shuffle=True, random_state=seed))
+        # as in ml_classify.py, the features are selected on the full data set, with the same scores for every fold
+        fold_scores = [chi2(X, y)[0]] * folds
+    print("CV folds: %s" % folds)
+
+    combinations = list(itertools.product(grid_k, grid_C, grid_class_weight))
+    tasks = [(fold_index, k, C, class_weight)
+             for k, C, class_weight in combinations for fold_index in range(folds)]
+    print("Fitting %s combinations x %s folds" % (len(combinations), folds))
+
+    n_jobs = config.get('n_jobs', 1)
+    if n_jobs > 1:
+        with multiprocessing.Pool(n_jobs, initializer=init_sweep_worker,
+                                  initargs=(X, y, skf, fold_scores, config, seed, fold_matrices)) as pool:
+            fit_results = pool.map(run_fit, tasks)
+    else:
+        init_sweep_worker(X, y, skf, fold_scores, config, seed, fold_matrices)
+        fit_results = list(map(run_fit, tasks))
+
+    table = []
+    for i, (k, C, class_weight) in enumerate(combinations):
+        fold_results = fit_results[i * folds:(i + 1) * folds]
+        f2 = np.array([global_stats[2] for stats, global_stats in fold_results])
+        roc_auc = np.array([np.mean(stats[3]) for stats, global_stats in fold_results])
+        pr_auc = np.array([np.mean(stats[4]) for stats, global_stats in fold_results])
+        table.append((k, C, class_weight, f2, roc_auc, pr_auc))
+    table.sort(key=lambda x: (np.mean(x[3]), np.mean(x[4]), np.mean(x[5])), reverse=True)
+
+    print("Ranked by F2 score (ROC-AUC and PR-AUC are averaged over labels):")
+    for rank, (k, C, class_weight, f2, roc_auc, pr_auc) in enumerate(table, 1):
+        print("%s. chi2_k=%s C=%s class_weight=%s" % (rank, k, C, class_weight))
+        for metric, sd in (('F2 score', f2), ('ROC-AUC score', roc_auc), ('PR-AUC score', pr_auc)):
+            print("    %s: %.2f %s" % (metric, np.mean(sd), confidence_interval(sd)))
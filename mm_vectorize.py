@@ -10,10 +10,14 @@ import xml.etree.ElementTree as ET
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 
+from hashing_features import HashingTfidfVectorizer
 from print_study import filter_study
+from study_text import sentence_texts
 
 DATABASE = 'studies.sqlite'
 METAMAP_XML_DIR = 'metamap_out'
+# number of hashed n-gram columns (see hashing_features.py), or None to build a vocabulary with TfidfVectorizer
+HASHING_FEATURES = None
 
 REMOVE_PUNC = str.maketrans({key: None for key in string.punctuation})
 
@@ -72,32 +76,32 @@ def get_features(study_id):
         return features_list, names
 
 
-def features_to_text(features, text):
+def features_to_text(features, text, on_overlap='raise', skipped=None):
     """
-    Replace text with features from the specified feature dictionary
+    Replace text with features from the specified feature list of (tokens, start, length) tuples. Features are applied
+    in order of their start position. A feature starting inside the span replaced by an earlier one raises ValueError,
+    or if on_overlap is 'skip', is dropped and appended to the skipped list when one is given. Features starting at or
+    past the end of the text are ignored.
     """
-
+    if on_overlap not in ('skip', 'raise'):
+        raise ValueError("on_overlap must be 'skip' or 'raise'")
+    pieces = []
     i = 0
     orig_length = len(text)
-    new_text = ''
-    f = None
-    while i < orig_length:
-        if f is None:
-            if len(features):
-                f = features.pop(0)
-            else:
-                new_text += text[i:]
-                break
-        if i == f[1]:
-            new_text += ' '.join(f[0]) + ' '
-            i += f[2]
-            f = None
-        else:
-            new_text += text[i:f[1]]
-            i = f[1]
-
-    return new_text
-
+    for tokens, start, length in sorted(features, key=lambda f: f[1]):
+        if start >= orig_length:
+            break
+        if start < i:
+            if on_overlap == 'raise':
+                raise ValueError("feature %r at %s overlaps the span ending at %s" % (tokens, start, i))
+            if skipped is not None:
+                skipped.append((tokens, start, length))
+            continue
+        pieces.append(text[i:start])
+        pieces.append(' '.join(tokens) + ' ')
+        i = start + length
+    pieces.append(text[i:])
+    return ''.join(pieces)
 
 
 if __name__ == '__main__':
@@ -109,14 +113,21 @@ if __name__ == '__main__':
 
     def gen_documents(sids, cn):
         counter = 0
+        total_skipped = 0
         c.execute('SELECT t1.NCTId, t1.BriefTitle, t1.Condition, t1.EligibilityCriteria \
                    FROM studies AS t1, hiv_status AS t2 WHERE t1.NCTId=t2.NCTId ORDER BY t1.NCTId')
-        for row in c.fetchall():
+        rows = c.fetchall()
+        for row, sentences in zip(rows, sentence_texts(conn, [(row[0], row[3]) for row in rows])):
             study_id = row[0]
             sids.append(study_id)
             features, names = get_features(study_id)
-            text = filter_study(*row[1:])
-            text = features_to_text(features, text)
+            text = filter_study(*row[1:], sentences=sentences)
+            # MetaMap can map overlapping spans of a phrase; the later ones are dropped and reported
+            skipped = []
+            text = features_to_text(features, text, on_overlap='skip', skipped=skipped)
+            if skipped:
+                total_skipped += len(skipped)
+                sys.stderr.write("%s: skipped %s overlapping features\n" % (study_id, len(skipped)))
             # text = text.translate(REMOVE_PUNC)
             cn.update(names)
             counter += 1
@@ -124,8 +135,13 @@ if __name__ == '__main__':
             # sys.stderr.write(text + '\n')
             sys.stderr.write("[%s] %s\n" % (counter, study_id))
             yield text
+        if total_skipped:
+            sys.stderr.write("Skipped %s overlapping features in total\n" % total_skipped)
 
-    vectorizer = TfidfVectorizer(ngram_range=(1, 2))
+    if HASHING_FEATURES:
+        vectorizer = HashingTfidfVectorizer(HASHING_FEATURES)
+    else:
+        vectorizer = TfidfVectorizer(ngram_range=(1, 2))
     X = vectorizer.fit_transform(gen_documents(study_ids, cui_names))
     data = {
         'vectorizer': vectorizer,
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# Compact exported model: IDF weights and linear SVM coefficients of the selected features as memory-mapped .npy files
+
+import argparse
+from collections import Counter
+import functools
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+from cui_features import TextCUIVectorizer
+from hashing_features import HashingTfidfVectorizer
+
+ARTIFACT_VERSION = 1
+# arrays every compact model has; vocabulary-based models also store the n-grams of their selected features in terms
+ARRAY_NAMES = ('keys', 'idf', 'selected_keys', 'coef', 'intercept')
+# number of n-gram keys memoized by each loaded model
+KEY_CACHE_SIZE = 1 << 18
+
+
+def term_key(term):
+    """Returns the 64-bit key under which a vocabulary term is stored"""
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def make_key(manifest):
+    """Returns the function mapping an n-gram to its key in a model with the given manifest"""
+    if manifest['features'] == 'hashing':
+        from sklearn.utils import murmurhash3_32  # HashingVectorizer's hash function
+        n_features = manifest['n_features']
+        return lambda ngram: abs(murmurhash3_32(ngram, seed=0)) % n_features
+    return term_key
+
+
+def make_analyzer(ngram_range=(1, 2), lowercase=True, token_pattern=r"(?u)\b\w\w+\b"):
+    """Returns a function splitting a text into word n-grams the way the default scikit-learn word analyzer does"""
+    find_tokens = re.compile(token_pattern).findall
+    min_n, max_n = ngram_range
+
+    def analyze(text):
+        tokens = find_tokens(text.lower() if lowercase else text)
+        if max_n == 1:
+            return tokens
+        ngrams = list(tokens) if min_n == 1 else []
+        for n in range(max(min_n, 2), max_n + 1):
+            ngrams.extend(map(' '.join, zip(*[tokens[i:] for i in range(n)])))
+        return ngrams
+    return analyze
+
+
+def analyzer_params(vectorizer):
+    """Returns the analyzer settings of a word n-gram vectorizer; raises ValueError if make_analyzer can't mimic it"""
+    params = vectorizer.get_params()
+    if (params.get('analyzer') != 'word' or params.get('preprocessor') or params.get('tokenizer') or
+            params.get('stop_words') or params.get('strip_accents')):
+        raise ValueError("only plain word n-gram analyzers can be exported in the compact format")
+    if params.get('binary'):
+        raise ValueError("binary term counts can't be exported in the compact format")
+    return {'ngram_range': list(params['ngram_range']), 'lowercase': params['lowercase'],
+            'token_pattern': params['token_pattern']}
+
+
+def check_tfidf_params(vectorizer):
+    """Raises ValueError unless a TfidfVectorizer weights terms the way CompactModel does"""
+    params = vectorizer.get_params()
+    if (params.get('sublinear_tf') or params.get('norm') != 'l2' or not params.get('use_idf') or
+            not params.get('smooth_idf')):
+        raise ValueError("only TF-IDF with raw term counts, smoothed IDF weights and L2 normalization can be exported "
+                         "in the compact format")
+
+
+def compact(vectorizer, selector, model):
+    """
+    Returns the manifest and arrays of the compact form of a fitted text vectorizer (TfidfVectorizer or
+    HashingTfidfVectorizer), feature selector and linear model. Only the selected features get their n-grams and
+    coefficients stored. The L2 norm of a document vector spans every feature though, so the IDF weights of all
+    features are kept too, under 64-bit keys: the blake2b hash of each vocabulary term, or the hashed column index.
+    """
+    if isinstance(vectorizer, TextCUIVectorizer):
+        raise ValueError("the compact format does not support CUI features")
+    columns = selector.get_support(indices=True)
+    manifest = {'version': ARTIFACT_VERSION, 'classes': model.classes_.tolist()}
+    arrays = {'coef': np.asarray(model.coef_, dtype=np.float64),
+              'intercept': np.asarray(model.intercept_, dtype=np.float64)}
+    if isinstance(vectorizer, HashingTfidfVectorizer):
+        manifest.update(analyzer_params(vectorizer.hashing_vectorizer), features='hashing',
+                        n_features=vectorizer.n_features, unseen_idf=float(vectorizer.idf([-1])[0]))
+        arrays.update(keys=vectorizer.df_indices_.astype(np.uint64), idf=vectorizer.idf(vectorizer.df_indices_),
+                      selected_keys=columns.astype(np.uint64))
+    else:
+        check_tfidf_params(vectorizer)
+        manifest.update(analyzer_params(vectorizer), features='vocabulary', unseen_idf=None)
+        terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+        all_keys = np.array([term_key(t) for t in terms], dtype=np.uint64)
+        order = np.argsort(all_keys)
+        if len(np.unique(all_keys)) != len(all_keys):
+            raise ValueError("vocabulary term keys collide")
+        arrays.update(keys=all_keys[order], idf=np.asarray(vectorizer.idf_)[order], selected_keys=all_keys[columns],
+                      terms=np.frombuffer('\n'.join(terms[i] for i in columns).encode('utf-8'), dtype=np.uint8))
+    return manifest, arrays
+
+
+def save(path, vectorizer, selector, model):
+    """
+    Writes the compact form of a fitted vectorizer, selector and model as .npy arrays and a manifest.json. An existing
+    directory at path is only replaced if it holds a previous compact model.
+    """
+    if os.path.isdir(path) and not os.path.isfile(os.path.join(path, 'manifest.json')):
+        raise ValueError("%s is a directory but not a compact model, refusing to replace it" % path)
+    manifest, arrays = compact(vectorizer, selector, model)
+    parent = os.path.dirname(os.path.abspath(path))
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.chmod(tmp_path, 0o0755)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+class CompactModel(object):
+    """
+    A model written by save(), with its arrays memory-mapped so that loading is cheap and worker processes share
+    the pages. Documents are scored with one sparse product between their selected features and the coefficients.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != ARTIFACT_VERSION:
+            raise ValueError("unsupported model artifact version %s" % self.manifest['version'])
+        self.arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ARRAY_NAMES}
+        for name, array in self.arrays.items():
+            setattr(self, name, array)
+        self.classes_ = np.array(self.manifest['classes'])
+        self.unseen_idf = self.manifest['unseen_idf']
+        self.analyze = make_analyzer(self.manifest['ngram_range'], self.manifest['lowercase'],
+                                     self.manifest['token_pattern'])
+        self.key = functools.lru_cache(maxsize=KEY_CACHE_SIZE)(make_key(self.manifest))
+        self.selected_order = np.argsort(self.selected_keys)
+        self.sorted_selected_keys = np.asarray(self.selected_keys)[self.selected_order]
+
+    def lookup(self, table, keys):
+        """Returns the positions of keys in the sorted table and a mask of the keys found"""
+        pos = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+        return pos, table[pos] == keys
+
+    def features(self, texts):
+        """Returns the L2-normalized TF-IDF values of the selected features of texts as a sparse matrix"""
+        data = []
+        indices = []
+        indptr = [0]
+        for text in texts:
+            counts = Counter(self.analyze(text))
+            keys = np.fromiter(map(self.key, counts), dtype=np.uint64, count=len(counts))
+            tf = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+            if self.manifest['features'] == 'hashing':  # n-grams hashed to the same column add up
+                keys, inverse = np.unique(keys, return_inverse=True)
+                tf = np.bincount(inverse, weights=tf)
+            pos, seen = self.lookup(self.keys, keys)
+            if self.unseen_idf is None:  # a vocabulary ignores the terms it wasn't fitted on
+                keys, tf = keys[seen], tf[seen]
+                weights = tf * self.idf[pos[seen]]
+            else:
+                weights = tf * np.where(seen, self.idf[pos], self.unseen_idf)
+            norm = np.sqrt(np.dot(weights, weights))
+            if norm > 0:
+                pos, selected = self.lookup(self.sorted_selected_keys, keys)
+                data.append(weights[selected] / norm)
+                indices.append(self.selected_order[pos[selected]])
+                indptr.append(indptr[-1] + len(data[-1]))
+            else:
+                indptr.append(indptr[-1])
+        if data:
+            data, indices = np.concatenate(data), np.concatenate(indices)
+        return sp.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, len(self.selected_keys)))
+
+    def decision_function(self, texts):
+        scores = self.features(texts).dot(np.asarray(self.coef).T) + self.intercept
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def labels(self, scores):
+        if scores.ndim == 1:
+            return self.classes_[(scores > 0).astype(int)]
+        return self.classes_[scores.argmax(axis=1)]
+
+    def predict(self, texts):
+        return self.labels(self.decision_function(texts))
+
+    def score(self, texts):
+        """Returns the predicted labels and decision function values of texts"""
+        scores = self.decision_function(texts)
+        return self.labels(scores), scores
+
+
+class PayloadModel(object):
+    """The vectorizer, chi2 selection and model of a pickled payload, with the interface of CompactModel"""
+
+    def __init__(self, payload):
+        super().__init__()
+        self.payload = payload
+        self.classes_ = payload['model'].classes_
+
+    def features(self, texts):
+        return self.payload['chi2_best'].transform(self.payload['vectorizer'].transform(texts))
+
+    def decision_function(self, texts):
+        return self.payload['model'].decision_function(self.features(texts))
+
+    def predict(self, texts):
+        return self.payload['model'].predict(self.features(texts))
+
+    def score(self, texts):
+        X = self.features(texts)
+        return self.payload['model'].predict(X), self.payload['model'].decision_function(X)
+
+
+def load(path):
+    """Returns the model exported by ml_classify.py to path: a compact model directory or a pickled payload"""
+    if os.path.isdir(path):
+        return CompactModel(path)
+    with open(path, 'rb') as f:
+        return PayloadModel(pickle.load(f))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('payload', help='path to a pickled model payload exported by ml_classify.py')
+    parser.add_argument('output', help='directory to write the compact model to')
+    ns = parser.parse_args()
+
+    with open(ns.payload, 'rb') as f:
+        payload = pickle.load(f)
+    save(ns.output, payload['vectorizer'], payload['chi2_best'], payload['model'])
+    print("Wrote compact model to " + ns.output)
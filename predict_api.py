@@ -1,35 +1,19 @@
-from flask import Flask, jsonify, request
-
-import pickle
-import re
-import string
-
+import os
 
+from flask import Flask, jsonify, request
 
-from sklearn.feature_selection import chi2, SelectKBest
-from sklearn.feature_extraction.text import TfidfVectorizer
+import inference
+import model_artifact
+from segment import filter_study
 
 app = Flask(__name__)
+app.config['MAX_BATCH_SIZE'] = 1000  # maximum number of studies accepted by /batch
 
-model_payload_path = "models/cancer_hiv.pickle"
-with open(model_payload_path, 'rb') as f:
-    model_payload = pickle.load(f)
-
-REMOVE_PUNC = str.maketrans({key: None for key in string.punctuation})
-
-def filter_study(ec):
-    """take one study and returns a filtered version with only relevant lines included"""
-    lines = []
-    segments = re.split(
-        r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
-        ec, flags=re.MULTILINE)
-    for i, l in enumerate(segments):
-        l = l.strip()
-        if l:
-            l = l.translate(REMOVE_PUNC).strip()
-            if l:
-                lines.append(l)
-    return '\n'.join(lines)
+# a pickled payload or a compact model directory exported by ml_classify.py
+model_payload_path = os.environ.get('PREDICT_MODEL_PATH', "models/cancer_hiv.pickle")
+model = model_artifact.load(model_payload_path)
+# single studies are scored with the compiled lookup table, batches with one sparse product over all of them
+scorer = inference.from_model(model)
 
 
 @app.route("/", methods=['POST'])
@@ -41,19 +25,39 @@ def predict():
     text[0] = request.get_json()['x']
 
 
-    vectorizer = model_payload['vectorizer']
-
-
     text[0] = filter_study(text[0])
 
-    tr = vectorizer.transform(text)
-
-    chi2_best = model_payload['chi2_best']
-
-    tr = chi2_best.transform(tr)
-
+    val = str(scorer.predict(text)[0])
 
+    return val, 200
 
-    val =str(model_payload['model'].predict(tr[0])[0])
 
-    return val, 200
+@app.route("/batch", methods=['POST'])
+def predict_batch():
+    """
+    Score a JSON array of {"nct_id": ..., "x": ...} records in one pass over a single sparse matrix
+    """
+    records = request.get_json()
+    if not isinstance(records, list):
+        return jsonify(error="expected a JSON array of {nct_id, x} records"), 400
+    if len(records) > app.config['MAX_BATCH_SIZE']:
+        return jsonify(error="batch size %s exceeds maximum of %s" %
+                       (len(records), app.config['MAX_BATCH_SIZE'])), 413
+    if not records:
+        return jsonify([]), 200
+    try:
+        study_ids = [r['nct_id'] for r in records]
+        text = [filter_study(r['x']) for r in records]
+    except (KeyError, TypeError) as e:
+        return jsonify(error="malformed record: %s" % e), 400
+
+    y_predicted, y_predicted_score = model.score(text)
+
+    results = []
+    for study_id, label, score in zip(study_ids, y_predicted, y_predicted_score):
+        results.append({
+            'nct_id': study_id,
+            'label': int(label),
+            'score': score.tolist()  # a float for binary models, one value per class otherwise
+        })
+    return jsonify(results), 200
@@ -1,32 +1,27 @@
 #!/usr/bin/env python3
 
-import re
 import sqlite3
-import string
-import subprocess
 import sys
 
+from segment import split_sentences
+from transliterate import to_ascii
+
 DATABASE = 'studies.sqlite'
 
 
-def filter_study(title, condition, ec):
-    """take one study and returns a filtered version with only relevant lines included"""
+def filter_study(title, condition, ec, sentences=None):
+    """
+    take one study and returns a filtered version with only relevant lines included. sentences are the ASCII
+    sentences of ec if they have already been computed (see study_text.py)
+    """
     lines = [title + '.']
     for l in condition.split('\n'):
         lines.append(l + '.')
-    segments = re.split(
-        r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
-        ec, flags=re.MULTILINE)
-    for i, l in enumerate(segments):
-        l = l.strip()
-        if l:
-            if l:
-                if ' ' in l and l[-1] not in string.punctuation:
-                    l += '.'
-                lines.append(l)
-    text = '\n'.join(lines)
-    cp = subprocess.run(['iconv', '-t', 'ascii//TRANSLIT'], input=text, stdout=subprocess.PIPE, universal_newlines=True)
-    return cp.stdout
+    if sentences is None:
+        sentences = to_ascii('\n'.join(split_sentences(ec)))
+    if sentences:
+        lines.append(sentences)
+    return to_ascii('\n'.join(lines))
 
 if __name__ == '__main__':
     conn = sqlite3.connect(DATABASE)
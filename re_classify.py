@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 
+import argparse
+import json
+import multiprocessing
 import re
 import sqlite3
+import sys
 
 import numpy as np
 from sklearn import metrics, cross_validation
 from scipy import stats as ST
 
+from regex_engine import RegexEngine
+
 DATABASE = 'studies.sqlite'
 
 ALWAYS_POSITIVE_SIGNATURES = (
@@ -72,65 +78,158 @@ for x in POSITIVE_SIGNATURES:
     NEGATIVE_REGEXES.append((re.compile(r'not? [A-Z0-9 -,]*?' + x, flags=re.IGNORECASE), -1))
 
 REGEXES = ALWAYS_POSITIVE_REGEXES + NEGATIVE_REGEXES + POSITIVE_ONLY_REGEXES + POSITIVE_REGEXES
+ENGINE = RegexEngine(REGEXES)
 
+BLOCK_REGEX = re.compile(r"^(.*(?:criteri|characteristics).*)$", flags=re.MULTILINE | re.IGNORECASE)
+SEGMENT_REGEX = re.compile(r'(\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|[A-Za-z]+ ?: +|; +)',
+                           flags=re.MULTILINE)
 
-def score_text(label, text):
+
+def split_blocks(text):
+    """Splits a study into blocks separated by lines that look like inclusion/exclusion criteria headers"""
+    return BLOCK_REGEX.split(text)
+
+
+def split_segments(blk):
+    """Splits a block into segments; the separators are kept as segments of their own"""
+    return SEGMENT_REGEX.split(blk)
+
+
+def match_segment(l):
+    """Returns the first (regex, value) pair in REGEXES found in the segment, or None"""
+    return ENGINE.match(l)
+
+
+def score_study(label, text, log=None):
+    """
+    Scores one study and returns a dict with its NCTId, predicted class (0 = ineligible, 1 = indeterminate,
+    2 = eligible), total score, and the block, matched rule and score of every segment (rule and score are None
+    for segments no rule matched). If log is given, it is called with a line of trace output for each step.
+    """
+    result = {'nct_id': label, 'prediction': 1, 'score': 0, 'segments': []}
     if not (re.search('HIV', text) or re.search('human immunodeficiency virus', text, flags=re.IGNORECASE)):
-        return 1
-    chunks = re.split(r"^(.*(?:criteri|characteristics).*)$", text, flags=re.MULTILINE | re.IGNORECASE)
+        return result
+    chunks = split_blocks(text)
     score = 0
     multiplier = 1
+    block = None
     for blk in chunks:
         blk = blk.strip()
         if re.search(r'criteri|characteristics', blk, flags=re.IGNORECASE):
             if re.search('exclusion|exclude|non.?inclusion|not [A-Z-a-z]*eligible|ineligible', blk.lower()):
                 multiplier = -1
-                print("[EXCLUSION BLOCK]")
+                block = 'exclusion'
+                if log:
+                    log("[EXCLUSION BLOCK]")
             elif re.search('inclusion|include|eligible', blk.lower()):
                 multiplier = 1
-                print("[INCLUSION BLOCK]")
-        pre = None
-        segments = re.split(r'(\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|[A-Za-z]+ ?: +|; +)', blk,
-                            flags=re.MULTILINE)
+                block = 'inclusion'
+                if log:
+                    log("[INCLUSION BLOCK]")
+        segments = split_segments(blk)
         for i, l in enumerate(segments):
             if l:
                 l = l.strip()
-                matched = False
-                for rx, v in REGEXES:
-                    if rx.search(l):
-                        matched = True
-                        s = v * multiplier  # the default
-                        # handle special cases
-                        if v is True or (multiplier == 1 and v == 1):
-                            s = 2
-                        elif v == 1:
-                            for sx in POSITIVE_SUFFIX_REGEXES:
-                                if sx.search(l):
-                                    s = 1
-                                    break
-                        score += s
-                        print("[%s, %s] (%s): %s" % (label, s, rx, l))
-                        break
-                if not matched:
-                    print("[%s, UNKNOWN] %s" % (label, l))
-    print("[%s] Score: %s" % (label, score))
+                hit = match_segment(l)
+                if hit is not None:
+                    rx, v = hit
+                    s = v * multiplier  # the default
+                    # handle special cases
+                    if v is True or (multiplier == 1 and v == 1):
+                        s = 2
+                    elif v == 1:
+                        for sx in POSITIVE_SUFFIX_REGEXES:
+                            if sx.search(l):
+                                s = 1
+                                break
+                    score += s
+                    result['segments'].append({'text': l, 'block': block, 'rule': rx.pattern, 'score': s})
+                    if log:
+                        log("[%s, %s] (%s): %s" % (label, s, rx, l))
+                else:
+                    result['segments'].append({'text': l, 'block': block, 'rule': None, 'score': None})
+                    if log:
+                        log("[%s, UNKNOWN] %s" % (label, l))
+    if log:
+        log("[%s] Score: %s" % (label, score))
+    result['score'] = score
     if score > 0:
-        return 2
+        result['prediction'] = 2
     elif score < 0:
-        return 0
-    else:
-        return 1
+        result['prediction'] = 0
+    return result
+
+
+def score_text(label, text):
+    return score_study(label, text, log=print)['prediction']
+
+
+def score_chunk(studies):
+    return [score_study(label, text) for label, text in studies]
+
+
+def score_studies(studies, processes=None, chunk_size=100):
+    """
+    Scores an iterable of (NCTId, text) pairs without any output and returns the score_study() results in order. If
+    processes is given, chunks of chunk_size studies are scored in a pool of that many worker processes.
+    """
+    if not processes or processes == 1:
+        return score_chunk(studies)
+    studies = list(studies)
+    chunks = [studies[i:i + chunk_size] for i in range(0, len(studies), chunk_size)]
+    results = []
+    with multiprocessing.Pool(processes) as pool:
+        for chunk_results in pool.imap(score_chunk, chunks):  # imap keeps the chunks in order
+            results.extend(chunk_results)
+    return results
+
+
+def write_jsonl(results, path):
+    """Writes score_study() results as JSON Lines to path, or to stdout if path is '-'"""
+    f = sys.stdout if path == '-' else open(path, 'w')
+    for result in results:
+        f.write(json.dumps(result) + '\n')
+    if f is not sys.stdout:
+        f.close()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', metavar='FILE', dest='db_path', default=DATABASE,
+                        help='SQLite database file to use')
+    parser.add_argument('--jsonl', metavar='FILE',
+                        help='write the per-study results as JSON Lines to FILE ("-" for stdout) '
+                             'instead of printing every segment')
+    parser.add_argument('-j', dest='processes', type=int, default=None,
+                        help='score the studies quietly in a pool of this many worker processes')
+    parser.add_argument('-n', dest='chunk_size', type=int, default=100,
+                        help='number of studies per chunk sent to a worker process')
+    parser.add_argument('--all', action='store_true',
+                        help='score every interventional study, annotated or not, and skip the evaluation '
+                             '(requires --jsonl)')
+
+    ns = parser.parse_args()
+    if ns.all and not ns.jsonl:
+        parser.error('--all requires --jsonl')
+
     np.set_printoptions(precision=2)
 
-    for x in REGEXES:
-        print(x)
+    quiet = ns.jsonl or ns.processes
+    if not quiet:
+        for x in REGEXES:
+            print(x)
 
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(ns.db_path)
     c = conn.cursor()
 
+    if ns.all:
+        c.execute("SELECT NCTId, BriefTitle, Condition, EligibilityCriteria FROM studies \
+            WHERE StudyType LIKE '%Interventional%' ORDER BY NCTId")
+        results = score_studies(((row[0], '\n'.join(x or '' for x in row[1:4])) for row in c),
+                                processes=ns.processes, chunk_size=ns.chunk_size)
+        write_jsonl(results, ns.jsonl)
+        sys.exit(0)
+
     X = []
     y = []
     study_ids = []
@@ -155,6 +254,14 @@ if __name__ == '__main__':
     study_ids = np.array(study_ids)
     label_map = ('HIV-ineligible', 'indeterminate', 'HIV-eligible')
 
+    predictions = None
+    if quiet:
+        # scoring is independent of the folds, so score every study once, quietly, and look the results up per fold
+        results = score_studies(zip(study_ids, X), processes=ns.processes, chunk_size=ns.chunk_size)
+        predictions = np.array([result['prediction'] for result in results])
+        if ns.jsonl:
+            write_jsonl(results, ns.jsonl)
+
     seed = 0
     folds = 10
     skf = cross_validation.StratifiedKFold(y, n_folds=folds, shuffle=True, random_state=seed)
@@ -165,10 +272,13 @@ if __name__ == '__main__':
     for train, test in skf:
         X_test, y_test = X[test], y[test]
         y_test_all.extend(y_test)
-        y_pred = []
-        for sid, text in zip(study_ids[test], X_test):
-            y_pred.append(score_text(sid, text))
-        y_pred = np.array(y_pred)
+        if predictions is not None:
+            y_pred = predictions[test]
+        else:
+            y_pred = []
+            for sid, text in zip(study_ids[test], X_test):
+                y_pred.append(score_text(sid, text))
+            y_pred = np.array(y_pred)
         y_pred_all.extend(y_pred)
 
         sd = list(metrics.precision_recall_fscore_support(y_test, y_pred, beta=2, average=None))[:3]
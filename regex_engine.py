@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# First-match-wins matching over an ordered list of regexes, using combined alternations and literal pre-filters
+
+import re
+
+# Literals that a segment must contain for the patterns requiring them to have any chance of matching. Each gate
+# matches everything its literal matches under the same flags, so skipping a gated pattern never changes the result.
+LITERAL_GATES = (
+    ('hiv', re.compile(r'HIV|human immunodeficiency virus', flags=re.IGNORECASE)),
+    ('positiv', re.compile(r'positiv', flags=re.IGNORECASE)),
+    ('negativ', re.compile(r'negativ', flags=re.IGNORECASE)),
+)
+HIV_GROUP = '(HIV|human immunodeficiency virus)'
+QUANTIFIERS = '?*{'
+
+
+def skip_class(pattern, i):
+    """Returns the index just past the character class starting at pattern[i]"""
+    i += 1
+    if i < len(pattern) and pattern[i] == '^':
+        i += 1
+    if i < len(pattern) and pattern[i] == ']':
+        i += 1
+    while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return i + 1
+
+
+def skip_group(pattern, i):
+    """Returns the index just past the group starting at pattern[i]"""
+    depth = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\':
+            i += 2
+            continue
+        if ch == '[':
+            i = skip_class(pattern, i)
+            continue
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if depth == 0:
+                break
+        i += 1
+    return i + 1
+
+
+def top_level_items(pattern):
+    """
+    Splits a pattern into its top-level items as (kind, text, quantified) tuples, where kind is 'literal', 'escape',
+    'group', 'class', 'alternation' or 'meta'. Groups and character classes are returned whole.
+    """
+    items = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        ch = pattern[i]
+        if ch == '\\':
+            kind, j = 'escape', i + 2
+        elif ch == '[':
+            kind, j = 'class', skip_class(pattern, i)
+        elif ch == '(':
+            kind, j = 'group', skip_group(pattern, i)
+        elif ch == '|':
+            kind, j = 'alternation', i + 1
+        elif ch in '.^$':
+            kind, j = 'meta', i + 1
+        else:
+            kind, j = 'literal', i + 1
+        # a quantifier allowing zero repetitions makes the item optional; '+' does not
+        quantified = j < n and pattern[j] in QUANTIFIERS
+        items.append((kind, pattern[i:j], quantified))
+        i = j
+        while i < n and pattern[i] in '?*+{':
+            if pattern[i] == '{':
+                i = pattern.index('}', i) + 1
+            else:
+                i += 1
+    return items
+
+
+def required_gates(pattern):
+    """
+    Returns the names of the LITERAL_GATES a string must pass for pattern to match it. The analysis is
+    conservative: a pattern with a top-level alternation, or whose literal is optional, requires nothing.
+    """
+    items = top_level_items(pattern)
+    if any(kind == 'alternation' for kind, text, quantified in items):
+        return frozenset()
+    runs = []
+    run = ''
+    groups = set()
+    for kind, text, quantified in items:
+        if kind == 'literal' and not quantified:
+            run += text.lower()
+            continue
+        runs.append(run)
+        run = ''
+        if kind == 'group' and not quantified:
+            groups.add(text)
+    runs.append(run)
+    gates = set()
+    if HIV_GROUP in groups or any('hiv' in r for r in runs):
+        gates.add('hiv')
+    for name in ('positiv', 'negativ'):
+        if any(name in r for r in runs):
+            gates.add(name)
+    return frozenset(gates)
+
+
+class RegexEngine(object):
+    """
+    Equivalent to trying each (regex, value) pair in order and returning the first whose regex searches successfully.
+    The literal gates a text passes select the patterns that can possibly match it, and consecutive runs of those
+    are searched as one combined alternation. The combined regexes are compiled once per set of passed gates.
+    """
+
+    def __init__(self, regexes, group_size=8):
+        super().__init__()
+        self.regexes = list(regexes)
+        self.gates = [required_gates(rx.pattern) for rx, v in self.regexes]
+        self.group_size = group_size
+        self.plans = {}
+
+    def plan(self, passed):
+        """Returns the (combined regex, pattern indices) groups to try, in order, for a text passing these gates"""
+        groups = []
+        indices = [i for i, gates in enumerate(self.gates) if gates <= passed]
+        while indices:
+            flags = self.regexes[indices[0]][0].flags
+            end = 1
+            while end < len(indices) and end < self.group_size and self.regexes[indices[end]][0].flags == flags:
+                end += 1
+            group, indices = indices[:end], indices[end:]
+            combined = re.compile('|'.join('(?P<r%s>%s)' % (i, self.regexes[i][0].pattern) for i in group),
+                                  flags=flags)
+            groups.append((combined, group))
+        return groups
+
+    def match(self, text):
+        """Returns the first (regex, value) pair whose regex is found in text, or None"""
+        passed = frozenset(name for name, rx in LITERAL_GATES if rx.search(text))
+        groups = self.plans.get(passed)
+        if groups is None:
+            groups = self.plans[passed] = self.plan(passed)
+        for combined, group in groups:
+            m = combined.search(text)
+            if m is None:
+                continue
+            # the leftmost match is not necessarily from the earliest pattern, so check the ones before it
+            found = int(m.lastgroup[1:])
+            for i in group:
+                if i == found:
+                    break
+                if self.regexes[i][0].search(text):
+                    return self.regexes[i]
+            return self.regexes[found]
+        return None
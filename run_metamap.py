@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Runs MetaMap on the eligibility criteria of the annotated studies in a database with a pool of concurrent jobs
+
+import argparse
+import os
+import shlex
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from study_text import sentence_texts
+
+METAMAP_CMD = 'metamap --XMLf --prune 35 --blanklines 0 --negex'
+
+
+def get_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# read once, since setting it to read it is not thread-safe
+UMASK = get_umask()
+
+
+def pending_studies(conn, output_dir, force=False, changed_only=False):
+    """
+    Returns (NCTId, EligibilityCriteria) for the annotated studies that have no MetaMap output yet. With changed_only,
+    returns the annotated studies listed in study_changes instead, whether or not they have an output.
+    """
+    c = conn.cursor()
+    if changed_only:
+        c.execute('SELECT studies.NCTId, studies.EligibilityCriteria FROM studies, annotations, study_changes \
+            WHERE studies.NCTId=annotations.NCTId AND studies.NCTId=study_changes.NCTId ORDER BY studies.NCTId')
+        return c.fetchall()
+    c.execute('SELECT studies.NCTId, studies.EligibilityCriteria FROM studies, annotations \
+        WHERE studies.NCTId=annotations.NCTId ORDER BY studies.NCTId')
+    return [row for row in c.fetchall()
+            if force or not os.path.exists(os.path.join(output_dir, row[0] + '.xml'))]
+
+
+def write_atomic(path, data):
+    """
+    Writes data to path through a temporary file in the same directory, so path is never left partially written. The
+    file gets the permissions of a newly created file rather than the owner-only ones of the temporary file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o0666 & ~UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def run_job(cmd, study_id, text, output_dir, retries=2, timeout=None):
+    """
+    Runs cmd with text on stdin and stores its stdout as <output_dir>/<study_id>.xml. Failed attempts (non-zero exit
+    status or timeout) are retried up to retries times. Returns None on success or the last error message.
+    """
+    error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(min(2 ** attempt, 30))
+        try:
+            cp = subprocess.run(cmd, input=text.encode('ascii'), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=timeout)
+        except subprocess.TimeoutExpired:
+            error = 'timed out after %ss' % timeout
+            continue
+        if cp.returncode == 0 and cp.stdout:
+            write_atomic(os.path.join(output_dir, study_id + '.xml'), cp.stdout)
+            return None
+        error = 'exit status %s: %s' % (cp.returncode, cp.stderr.decode('utf-8', 'replace').strip()[-200:])
+    return error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', metavar='FILE', dest='db_path', default='studies.sqlite',
+                        help='SQLite database file to use')
+    parser.add_argument('-j', dest='jobs', type=int, default=4, help='number of MetaMap processes run at a time')
+    parser.add_argument('--retries', type=int, default=2, help='number of times a failed job is retried')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which a MetaMap job is killed')
+    parser.add_argument('--metamap-cmd', default=METAMAP_CMD,
+                        help='command that reads text on stdin and writes MetaMap XML to stdout '
+                             '(default: "%(default)s")')
+    parser.add_argument('--force', action='store_true', help='rerun studies that already have an output file')
+    parser.add_argument('--changed-only', action='store_true',
+                        help='only (re)run the studies listed in the study_changes table by se2sqlite.py --upsert')
+    parser.add_argument('output_dir', help='directory the <NCTId>.xml output files are written to')
+    ns = parser.parse_args()
+
+    if not os.path.exists(ns.output_dir):
+        os.makedirs(ns.output_dir, 0o0755)
+
+    conn = sqlite3.connect(ns.db_path)
+    if ns.changed_only and not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='study_changes'").fetchone():
+        sys.exit("%s has no study_changes table: --changed-only needs a database updated with se2sqlite.py --upsert"
+                 % ns.db_path)
+    studies = pending_studies(conn, ns.output_dir, ns.force, ns.changed_only)
+    # the text 'manual_annotator.py print --ec-only --ascii' prints
+    texts = [text + '\n' for text in sentence_texts(conn, studies)]
+    conn.close()
+    sys.stderr.write("%s studies to process\n" % len(studies))
+
+    cmd = shlex.split(ns.metamap_cmd)
+    failed = []
+    with ThreadPoolExecutor(ns.jobs) as executor:
+        futures = [(study_id, executor.submit(run_job, cmd, study_id, text, ns.output_dir, ns.retries, ns.timeout))
+                   for (study_id, ec), text in zip(studies, texts)]
+        for i, (study_id, future) in enumerate(futures, 1):
+            error = future.result()
+            if error is None:
+                sys.stderr.write("[%s] %s\n" % (i, study_id))
+            else:
+                sys.stderr.write("[%s] %s failed: %s\n" % (i, study_id, error))
+                failed.append(study_id)
+
+    print("Processed %s studies, %s failed" % (len(studies), len(failed)))
+    if failed:
+        print("Failed: " + ' '.join(failed))
+        sys.exit(1)
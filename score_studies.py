@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Scores every study in a database with an exported model payload and stores the results in a predictions table
+
+import argparse
+import json
+import sqlite3
+import sys
+
+import model_artifact
+from segment import filter_study
+from study_text import filtered_texts
+
+
+def create_predictions_table(conn, table):
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (NCTId text PRIMARY KEY, prediction integer, score text)" % table)
+
+
+def last_scored_id(conn, table):
+    """Returns the highest NCTId already committed to the predictions table, or None"""
+    c = conn.cursor()
+    c.execute("SELECT MAX(NCTId) FROM %s" % table)
+    return c.fetchone()[0]
+
+
+def score_chunk(model, rows, text=None):
+    """
+    Returns a list of (NCTId, prediction, score) tuples for a chunk of (NCTId, EligibilityCriteria) rows. text holds
+    the filtered criteria of the rows if they have already been computed.
+    """
+    if text is None:
+        text = [filter_study(row[1] or '') for row in rows]
+    y_predicted, y_predicted_score = model.score(text)
+    return [(row[0], int(label), json.dumps(score.tolist()))
+            for row, label, score in zip(rows, y_predicted, y_predicted_score)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', dest='table', default='predictions',
+                        help='name of the table the predictions are written to')
+    parser.add_argument('-n', dest='chunk_size', type=int, default=1000,
+                        help='number of studies read, vectorized and written per chunk')
+    parser.add_argument('--restart', action='store_true',
+                        help='rescore all studies instead of resuming after the last committed NCTId')
+    parser.add_argument('--changed-only', action='store_true',
+                        help='only (re)score the studies listed in the study_changes table by se2sqlite.py --upsert')
+    parser.add_argument('model', help='path to a model payload or compact model directory exported by ml_classify.py')
+    parser.add_argument('database', help='path to the SQLite database containing the studies table')
+
+    ns = parser.parse_args()
+
+    model = model_artifact.load(ns.model)
+
+    conn = sqlite3.connect(ns.database)
+    if ns.changed_only and not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='study_changes'").fetchone():
+        sys.exit("%s has no study_changes table: --changed-only needs a database updated with se2sqlite.py --upsert"
+                 % ns.database)
+    create_predictions_table(conn, ns.table)
+    conn.commit()
+
+    start_id = None if ns.restart or ns.changed_only else last_scored_id(conn, ns.table)
+    if start_id is not None:
+        sys.stderr.write("Resuming after %s\n" % start_id)
+
+    c = conn.cursor()
+    if ns.changed_only:
+        c.execute('SELECT studies.NCTId, studies.EligibilityCriteria FROM studies, study_changes \
+            WHERE studies.NCTId=study_changes.NCTId ORDER BY studies.NCTId')
+    else:
+        c.execute('SELECT NCTId, EligibilityCriteria FROM studies WHERE NCTId > ? ORDER BY NCTId', [start_id or ''])
+    counter = 0
+    while True:
+        rows = c.fetchmany(ns.chunk_size)
+        if not rows:
+            break
+        # one transaction per chunk, so an interrupted run can resume from the last committed NCTId
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO %s VALUES(?, ?, ?)" % ns.table,
+                             score_chunk(model, rows, filtered_texts(conn, rows)))
+        counter += len(rows)
+        sys.stderr.write("[%s] %s\n" % (counter, rows[-1][0]))
+    print("Scored %s records" % counter)
+    conn.close()
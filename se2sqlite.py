@@ -3,67 +3,207 @@
 import argparse
 from collections import OrderedDict
 from datetime import datetime
+import functools
+import hashlib
+import json
 import random
 import sqlite3
 import sys
 import xml.etree.ElementTree as ET
 
+# stays well below SQLite's default limit on the number of bound parameters
+QUERY_BATCH_SIZE = 500
+
+
 def convert_ct_start_date(ds):
     """Convert a ClinicalTrials.gov start date to ISO 8601 YYYY-MM-DD"""
     return datetime.strptime(ds, "%B %Y").strftime("%Y-%m-%d")
 
 
+def iter_studies(input_xml, stream=False):
+    """
+    Yields the STUDY elements that are direct children of the root of an SE4 XML dump. With stream, the file is
+    parsed incrementally and each child of the root is discarded once it has been read (and the caller is done with
+    it, for a study), so memory use does not grow with the size of the dump.
+    """
+    if not stream:
+        yield from ET.parse(input_xml).getroot().findall('STUDY')
+        return
+    root = None
+    depth = 0  # number of open elements
+    for event, elem in ET.iterparse(input_xml, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:  # a child of the root
+            if elem.tag == 'STUDY':
+                yield elem
+            root.clear()
+
+
+def column_schema(study):
+    col_schema = OrderedDict()
+    for child in study:
+        col_schema[child.tag] = 'text'
+        if child.tag == 'NCTId':
+            col_schema[child.tag] += ' PRIMARY KEY'
+    col_schema['category'] = 'text'
+    return col_schema
+
+
+def study_values(study, category):
+    values = OrderedDict()
+    for child in study:
+        if child.tag == 'StartDate':
+            values[child.tag] = convert_ct_start_date(child.text)
+        elif child.tag in values:
+            values[child.tag] += '\n' + child.text
+        else:
+            values[child.tag] = child.text
+    values['category'] = category
+    return values
+
+
+def insert_batch(conn, placeholder, batch):
+    """
+    Inserts a batch of (NCTId, row) pairs with one executemany. If a row violates a constraint, the batch is rolled
+    back and inserted row by row so that only the offending rows are skipped. Returns the number of rows inserted.
+    """
+    conn.execute("SAVEPOINT batch")
+    try:
+        conn.executemany("INSERT INTO studies VALUES(%s)" % placeholder, [row for study_id, row in batch])
+    except sqlite3.IntegrityError:
+        conn.execute("ROLLBACK TO batch")
+        inserted = 0
+        for study_id, row in batch:
+            try:
+                conn.execute("INSERT INTO studies VALUES(%s)" % placeholder, row)
+            except sqlite3.IntegrityError as e:
+                print(study_id + ' ' + str(e))
+            else:
+                inserted += 1
+        conn.execute("RELEASE batch")
+        return inserted
+    conn.execute("RELEASE batch")
+    return len(batch)
+
+
+def create_sync_tables(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS study_hashes (NCTId text PRIMARY KEY, hash text)")
+    conn.execute("CREATE TABLE IF NOT EXISTS study_changes (NCTId text PRIMARY KEY, changed text)")
+
+
+def content_hash(fields):
+    return hashlib.sha1(json.dumps(list(fields)).encode('utf-8')).hexdigest()
+
+
+def select_in(conn, query, study_ids):
+    """Yields the rows of a query with an IN (%s) clause over study_ids, in chunks below SQLite's parameter limit"""
+    for i in range(0, len(study_ids), QUERY_BATCH_SIZE):
+        chunk = study_ids[i:i + QUERY_BATCH_SIZE]
+        c = conn.execute(query % ','.join('?' * len(chunk)), chunk)
+        for row in c:
+            yield c.description, row
+
+
+def upsert_batch(conn, placeholder, batch, changed):
+    """
+    Writes the (NCTId, row) pairs whose content hash (of all columns but the category) differs from the stored one,
+    and records them in study_changes. Studies loaded before hashes were kept are compared with their current row and
+    get their hash stored. Returns the number of rows written.
+    """
+    study_ids = [study_id for study_id, row in batch]
+    stored = {row[0]: row[1] for description, row in
+              select_in(conn, "SELECT NCTId, hash FROM study_hashes WHERE NCTId IN (%s)", study_ids)}
+    missing = [study_id for study_id in study_ids if study_id not in stored]
+    for description, row in select_in(conn, "SELECT * FROM studies WHERE NCTId IN (%s)", missing):
+        columns = [d[0] for d in description]
+        stored[row[columns.index('NCTId')]] = content_hash(v for k, v in zip(columns, row) if k != 'category')
+    unhashed = set(missing)
+    hashes = []
+    rows = []
+    changes = []
+    for study_id, row in batch:
+        h = content_hash(row[:-1])  # the category (last column) is not part of the content
+        if stored.get(study_id) != h:
+            rows.append(row)
+            changes.append((study_id, changed))
+        elif study_id not in unhashed:
+            continue
+        hashes.append((study_id, h))
+        stored[study_id] = h  # a study repeated in the dump is only written once
+        unhashed.discard(study_id)
+    conn.executemany("INSERT OR REPLACE INTO studies VALUES(%s)" % placeholder, rows)
+    conn.executemany("INSERT OR REPLACE INTO study_hashes VALUES(?, ?)", hashes)
+    conn.executemany("INSERT OR REPLACE INTO study_changes VALUES(?, ?)", changes)
+    return len(rows)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', dest='category', default='main',
                         help='a category to associate with the study records being added')
     parser.add_argument('-p', dest='probability', type=float, default=1.0,
                         help='selection probability from 0.0-1.0')
+    parser.add_argument('-b', dest='batch_size', type=int, default=1000,
+                        help='number of studies inserted per executemany batch')
+    parser.add_argument('--progress', type=int, default=1000,
+                        help='print the number of records added every time it grows by this many')
+    parser.add_argument('--stream', action='store_true',
+                        help='parse the XML incrementally and bulk-load with synchronous=OFF and WAL journaling')
+    parser.add_argument('--upsert', action='store_true',
+                        help='insert new studies and replace changed ones, skipping studies whose content hash is '
+                             'unchanged; the NCTIds written are listed in the study_changes table')
     parser.add_argument('input_xml', help='path to the input XML file')
     parser.add_argument('output_db', help='path to the output database file')
 
     ns = parser.parse_args()
 
-    tree = ET.parse(ns.input_xml)
-    root = tree.getroot()
-
-    col_schema = OrderedDict()
-    for child in root.find('STUDY'):
-        col_schema[child.tag] = 'text'
-        if child.tag == 'NCTId':
-            col_schema[child.tag] += ' PRIMARY KEY'
-    col_schema['category'] = 'text'
-    print(col_schema)
-
     conn = sqlite3.connect(ns.output_db)
+    if ns.stream:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+    if ns.upsert:
+        changed = datetime.now().isoformat(' ')
+        write_batch = functools.partial(upsert_batch, changed=changed)
+    else:
+        write_batch = insert_batch
     c = conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS studies (%s)" % ', '.join([' '.join([k, col_schema[k]]) for k in col_schema]))
+    col_schema = None
     counter = 0
-    for study in root.findall('STUDY'):
+    reported = 0
+    batch = []
+    for study in iter_studies(ns.input_xml, ns.stream):
+        if col_schema is None:
+            col_schema = column_schema(study)
+            print(col_schema)
+            c.execute("CREATE TABLE IF NOT EXISTS studies (%s)" %
+                      ', '.join([' '.join([k, col_schema[k]]) for k in col_schema]))
+            placeholder = ','.join('?' * len(col_schema.keys()))
+            if ns.upsert:
+                # study_changes lists the studies written by the most recent sync only
+                create_sync_tables(conn)
+                c.execute("DELETE FROM study_changes")
         if random.random() > 1 - ns.probability:
-            values = OrderedDict()
-            for child in study:
-                if child.tag == 'StartDate':
-                    values[child.tag] = convert_ct_start_date(child.text)
-                elif child.tag in values:
-                    values[child.tag] += '\n' + child.text
-                else:
-                    values[child.tag] = child.text
-            values['category'] = ns.category
+            values = study_values(study, ns.category)
             if set(values.keys()) == set(col_schema.keys()):
-                placeholder = ','.join('?' * len(col_schema.keys()))
-                try:
-                    c.execute("INSERT INTO studies VALUES(%s)" % placeholder, tuple(values.values()))
-                except sqlite3.IntegrityError as e:
-                    print(values.get('NCTId', '') + ' ' + str(e))
-                else:
-                    counter += 1
-                    print(counter)
+                batch.append((values.get('NCTId', ''), tuple(values.values())))
             else:
                 print("Schema mismatch: " + values.get('NCTId', ''))
+        if len(batch) >= ns.batch_size:
+            counter += write_batch(conn, placeholder, batch)
+            if counter - reported >= ns.progress:
+                reported = counter
+                print("[%s] %s" % (counter, batch[-1][0]))
+            batch = []
+    if batch:
+        counter += write_batch(conn, placeholder, batch)
     print("Added/updated %s records" % counter)
     conn.commit()
+    if ns.stream:
+        # leave a single self-contained database file behind
+        conn.execute("PRAGMA journal_mode=DELETE")
     conn.close()
-
-
-
@@ -1,28 +1,80 @@
 #!/usr/bin/env python3
 
+import argparse
 import sqlite3
-import sys
 import xml.etree.ElementTree as ET
 
 
-if __name__ == '__main__':
+def iter_purge_ids(input_xml):
+    """Yields the NCTId cells of an XML list of rows, parsing the file incrementally"""
+    for event, elem in ET.iterparse(input_xml):
+        if elem.tag == 'cell' and elem.get('column') == 'NCTId':
+            yield elem.text
+        elif elem.tag == 'row':
+            elem.clear()
+
 
-    conn = sqlite3.connect(sys.argv[1])
+def tables_with_nctid(conn):
+    """Returns the names of all tables that have an NCTId column, studies first"""
     c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
+    tables = []
+    for (name,) in c.fetchall():
+        columns = [row[1] for row in conn.execute('PRAGMA table_info("%s")' % name)]
+        if 'NCTId' in columns:
+            tables.append(name)
+    tables.sort(key=lambda name: name != 'studies')
+    return tables
+
 
-    tree = ET.parse(sys.argv[2])
+def bulk_delete(conn, study_ids, batch_size=10000):
+    """
+    Deletes the given studies from every table with an NCTId column (studies, annotations, cuis, predictions, ...)
+    in one transaction, with one set-based DELETE per table. Returns a list of (table, rows deleted) pairs.
+    """
+    conn.execute("CREATE TEMP TABLE purge_ids (NCTId text PRIMARY KEY)")
+    batch = []
+    for study_id in study_ids:
+        batch.append((study_id,))
+        if len(batch) >= batch_size:
+            conn.executemany("INSERT OR IGNORE INTO purge_ids VALUES(?)", batch)
+            batch = []
+    conn.executemany("INSERT OR IGNORE INTO purge_ids VALUES(?)", batch)
+    counts = []
+    with conn:
+        for table in tables_with_nctid(conn):
+            c = conn.execute('DELETE FROM "%s" WHERE NCTId IN (SELECT NCTId FROM temp.purge_ids)' % table)
+            counts.append((table, c.rowcount))
+    conn.execute("DROP TABLE temp.purge_ids")
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bulk', action='store_true',
+                        help='stream the NCTIds into a temporary table and delete them from studies and every other '
+                             'table with an NCTId column in one transaction')
+    parser.add_argument('database', help='path to the database file')
+    parser.add_argument('input_xml', help='path to an XML file of rows whose NCTId cells list the studies to delete')
+    ns = parser.parse_args()
 
-    first_row = tree.find('row')
-    counter = 0
-    for row in tree.iter('row'):
-        values = []
-        for cell in row.iter('cell'):
-            if cell.get('column') == 'NCTId':
-                c.execute("DELETE FROM studies WHERE NCTId=?", [cell.text])
-                counter += 1
-    print("Deleted %s records" % counter)
-    conn.commit()
-    conn.close()
+    conn = sqlite3.connect(ns.database)
 
+    if ns.bulk:
+        for table, count in bulk_delete(conn, iter_purge_ids(ns.input_xml)):
+            print("%s: deleted %s records" % (table, count))
+        conn.close()
+    else:
+        c = conn.cursor()
 
+        tree = ET.parse(ns.input_xml)
 
+        counter = 0
+        for row in tree.iter('row'):
+            for cell in row.iter('cell'):
+                if cell.get('column') == 'NCTId':
+                    c.execute("DELETE FROM studies WHERE NCTId=?", [cell.text])
+                    counter += 1
+        print("Deleted %s records" % counter)
+        conn.commit()
+        conn.close()
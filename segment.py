@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Shared eligibility criteria segmentation used for training, cross-validation and serving
+
+import multiprocessing
+import re
+import string
+import sys
+
+SEGMENT_REGEX = re.compile(
+    r'\n+|(?:[A-Za-z0-9\(\)]{2,}\. +)|(?:[0-9]+\. +)|(?:[A-Z][A-Za-z]+ )+?[A-Z][A-Za-z]+: +|; +| (?=[A-Z][a-z])',
+    flags=re.MULTILINE)
+PUNCTUATION_REGEX = re.compile('[%s]' % re.escape(string.punctuation))
+
+
+def filter_study(ec):
+    """take one study and returns a filtered version with only relevant lines included"""
+    # segments never contain a newline, so the punctuation can be stripped from all of them in one pass
+    text = PUNCTUATION_REGEX.sub('', '\n'.join(SEGMENT_REGEX.split(ec)))
+    return '\n'.join(l for l in (l.strip() for l in text.split('\n')) if l)
+
+
+def split_sentences(ec):
+    """
+    Returns the non-empty segments of the eligibility criteria, each terminated with a period if it has none
+    """
+    lines = []
+    for l in SEGMENT_REGEX.split(ec):
+        l = l.strip()
+        if l:
+            if ' ' in l and l[-1] not in string.punctuation:
+                l += '.'
+            lines.append(l)
+    return lines
+
+
+def filter_studies(ecs, processes=None, chunksize=256):
+    """
+    Returns filter_study() applied to each of the eligibility criteria in ecs, in order. If processes is
+    given, the work is spread across a pool of that many worker processes.
+    """
+    if not processes or processes == 1:
+        return [filter_study(ec) for ec in ecs]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(filter_study, ecs, chunksize)
+
+
+if __name__ == '__main__':
+    print(filter_study(sys.stdin.read()))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Production server for the prediction API: pre-forked workers share one listening socket and one memory-mapped model,
+# and each batches concurrent single-study requests
+
+import argparse
+from concurrent.futures import Future
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+import model_artifact
+from segment import filter_study
+
+DEFAULT_MODEL_PATH = 'models/cancer_hiv.pickle'
+# a worker exiting within MIN_UPTIME seconds of starting is restarted after a delay doubling from RESTART_DELAY up to
+# MAX_RESTART_DELAY seconds, and the server gives up after MAX_QUICK_EXITS such exits in a row
+MIN_UPTIME = 10.0
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+MAX_QUICK_EXITS = 5
+
+
+class MicroBatcher(object):
+    """
+    Scores the texts submitted by concurrent request threads in batches on a background thread. A batch is opened
+    by the first text to arrive and closed after window seconds or max_size texts, whichever comes first, and is
+    scored with a single model.score() call.
+    """
+
+    def __init__(self, model, window=0.005, max_size=64):
+        super().__init__()
+        self.model = model
+        self.window = window
+        self.max_size = max_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, text):
+        """Returns a Future of the (label, score) of text"""
+        future = Future()
+        self.queue.put((text, future))
+        return future
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                labels, scores = self.model.score([text for text, future in batch])
+            except Exception as e:
+                for text, future in batch:
+                    future.set_exception(e)
+                continue
+            for (text, future), label, score in zip(batch, labels, scores):
+                future.set_result((label, score))
+
+
+def create_app(model, model_path=None, batch_window=0.005, max_batch_size=64):
+    """
+    Returns the prediction API for a model loaded with model_artifact.load(). POST / scores one study through the
+    micro-batcher, POST /batch scores a JSON array of studies at once and GET /health reports the worker's state.
+    """
+    app = Flask(__name__)
+    app.config['MAX_BATCH_SIZE'] = 1000  # maximum number of studies accepted by /batch
+    batcher = MicroBatcher(model, batch_window, max_batch_size)
+
+    @app.route("/", methods=['POST'])
+    def predict():
+        text = filter_study(request.get_json()['x'])
+        label, score = batcher.submit(text).result()
+        return str(label), 200
+
+    @app.route("/batch", methods=['POST'])
+    def predict_batch():
+        """Score a JSON array of {"nct_id": ..., "x": ...} records with one call to the model"""
+        records = request.get_json()
+        if not isinstance(records, list):
+            return jsonify(error="expected a JSON array of {nct_id, x} records"), 400
+        if len(records) > app.config['MAX_BATCH_SIZE']:
+            return jsonify(error="batch size %s exceeds maximum of %s" %
+                           (len(records), app.config['MAX_BATCH_SIZE'])), 413
+        if not records:
+            return jsonify([]), 200
+        try:
+            study_ids = [r['nct_id'] for r in records]
+            text = [filter_study(r['x']) for r in records]
+        except (KeyError, TypeError) as e:
+            return jsonify(error="malformed record: %s" % e), 400
+        y_predicted, y_predicted_score = model.score(text)
+        return jsonify([{'nct_id': study_id, 'label': int(label), 'score': score.tolist()}
+                        for study_id, label, score in zip(study_ids, y_predicted, y_predicted_score)]), 200
+
+    @app.route("/health", methods=['GET'])
+    def health():
+        return jsonify(status='ok', model=model_path, pid=os.getpid(), pending=batcher.pending()), 200
+
+    return app
+
+
+def run_worker(sock, ns, model):
+    """Serves requests on the inherited listening socket until the process is terminated"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor handles Ctrl-C
+    app = create_app(model, ns.model, ns.batch_window / 1000.0, ns.max_batch_size)
+    server = make_server(ns.host, ns.port, app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+
+def fork_worker(sock, ns, model):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            run_worker(sock, ns, model)
+        except SystemExit:  # terminated by the supervisor
+            pass
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+    return pid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=os.environ.get('PREDICT_MODEL_PATH', DEFAULT_MODEL_PATH),
+                        help='pickled payload or compact model directory exported by ml_classify.py (default: '
+                             '$PREDICT_MODEL_PATH or %s)' % DEFAULT_MODEL_PATH)
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on')
+    parser.add_argument('-w', dest='workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--batch-window', type=float, default=5.0,
+                        help='milliseconds a micro-batch waits for more single-study requests')
+    parser.add_argument('--max-batch-size', type=int, default=64,
+                        help='maximum number of single-study requests scored together')
+    ns = parser.parse_args()
+
+    # loaded before forking, so the workers share the memory-mapped arrays of a compact model (or the copy-on-write
+    # pages of a pickled one)
+    model = model_artifact.load(ns.model)
+
+    sock = socket.socket(socket.AF_INET6 if ':' in ns.host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((ns.host, ns.port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    workers = {fork_worker(sock, ns, model): time.monotonic() for i in range(ns.workers)}  # pid -> start time
+    sys.stderr.write("Serving %s on http://%s:%s with %s workers\n" % (ns.model, ns.host, ns.port, len(workers)))
+    stopping = False
+    quick_exits = 0
+
+    def stop(signum=None, frame=None):
+        global stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while workers:
+        pid, status = os.wait()
+        uptime = time.monotonic() - workers.pop(pid)
+        if stopping:
+            continue
+        quick_exits = quick_exits + 1 if uptime < MIN_UPTIME else 0
+        if quick_exits >= MAX_QUICK_EXITS:
+            sys.stderr.write("Worker %s exited with status %s after %.1fs, %s workers exited within %ss of starting in "
+                             "a row, stopping\n" % (pid, status, uptime, quick_exits, MIN_UPTIME))
+            stop()
+            continue
+        delay = min(RESTART_DELAY * 2 ** (quick_exits - 1), MAX_RESTART_DELAY) if quick_exits else 0
+        # replace the worker that died, backing off while workers keep exiting soon after starting
+        sys.stderr.write("Worker %s exited with status %s after %.1fs, restarting in %ss\n" %
+                         (pid, status, uptime, delay))
+        time.sleep(delay)
+        if not stopping:
+            workers[fork_worker(sock, ns, model)] = time.monotonic()
+    sock.close()
+    if quick_exits >= MAX_QUICK_EXITS:
+        sys.exit(1)
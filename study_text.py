@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Side table of preprocessed eligibility criteria, recomputed only for studies whose text or preprocessing rules changed
+
+import argparse
+import hashlib
+import multiprocessing
+import sqlite3
+import sys
+
+from segment import filter_study, split_sentences
+from transliterate import to_ascii
+
+# bump whenever a change to segment.py or transliterate.py alters their output, so stored rows get recomputed
+RULES_VERSION = 1
+# stays well below SQLite's default limit on the number of bound parameters
+QUERY_BATCH_SIZE = 500
+
+
+def create_study_text_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS study_text \
+        (NCTId text PRIMARY KEY, version integer, source_hash text, filtered text, sentences text)")
+
+
+def source_hash(ec):
+    return hashlib.sha1((ec or '').encode('utf-8')).hexdigest()
+
+
+def preprocess(ec):
+    """
+    Returns the two preprocessed forms of a study's eligibility criteria: the segmented, punctuation-stripped lines
+    used as classifier features (segment.filter_study), and the segmented sentences transliterated to ASCII that are
+    fed to MetaMap
+    """
+    ec = ec or ''
+    return filter_study(ec), to_ascii('\n'.join(split_sentences(ec)))
+
+
+def preprocess_all(ecs, processes=None, chunksize=256):
+    if not processes or processes == 1:
+        return [preprocess(ec) for ec in ecs]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(preprocess, ecs, chunksize)
+
+
+def refresh(conn, processes=None):
+    """
+    Brings the study_text table up to date with the studies table: rows whose source text or rules version changed
+    are recomputed and rows of deleted studies are removed. Returns the numbers of rows updated and deleted.
+    """
+    create_study_text_table(conn)
+    c = conn.cursor()
+    c.execute("SELECT NCTId, version, source_hash FROM study_text")
+    stored = {row[0]: (row[1], row[2]) for row in c.fetchall()}
+    c.execute("SELECT NCTId, EligibilityCriteria FROM studies ORDER BY NCTId")
+    stale = []
+    for study_id, ec in c.fetchall():
+        h = source_hash(ec)
+        if stored.get(study_id) != (RULES_VERSION, h):
+            stale.append((study_id, ec, h))
+    results = preprocess_all([ec for study_id, ec, h in stale], processes)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO study_text VALUES(?, ?, ?, ?, ?)",
+                         [(study_id, RULES_VERSION, h, filtered, sentences)
+                          for (study_id, ec, h), (filtered, sentences) in zip(stale, results)])
+        deleted = conn.execute("DELETE FROM study_text WHERE NCTId NOT IN (SELECT NCTId FROM studies)").rowcount
+    return len(stale), deleted
+
+
+def lookup(conn, rows, column):
+    """
+    Returns the filtered or sentences form (by column name) of each (NCTId, EligibilityCriteria) row. Forms are read
+    from the study_text table where they are current and computed otherwise, so results never depend on whether
+    refresh() has been run.
+    """
+    index = ('filtered', 'sentences').index(column)
+    stored = {}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='study_text'").fetchone():
+        study_ids = [row[0] for row in rows]
+        for i in range(0, len(study_ids), QUERY_BATCH_SIZE):
+            chunk = study_ids[i:i + QUERY_BATCH_SIZE]
+            c = conn.execute("SELECT NCTId, source_hash, %s FROM study_text WHERE version=? AND NCTId IN (%s)" %
+                             (column, ','.join('?' * len(chunk))), [RULES_VERSION] + chunk)
+            stored.update((row[0], (row[1], row[2])) for row in c)
+    texts = []
+    for study_id, ec in rows:
+        h, text = stored.get(study_id, (None, None))
+        if h != source_hash(ec):
+            text = preprocess(ec)[index]
+        texts.append(text)
+    return texts
+
+
+def filtered_texts(conn, rows):
+    """Returns segment.filter_study() of the eligibility criteria of each (NCTId, EligibilityCriteria) row"""
+    return lookup(conn, rows, 'filtered')
+
+
+def sentence_texts(conn, rows):
+    """Returns the ASCII sentences of the eligibility criteria of each (NCTId, EligibilityCriteria) row"""
+    return lookup(conn, rows, 'sentences')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', metavar='FILE', dest='db_path', default='studies.sqlite',
+                        help='SQLite database file to use')
+    parser.add_argument('-j', dest='processes', type=int, default=None,
+                        help='number of worker processes used to preprocess the studies')
+    ns = parser.parse_args()
+
+    conn = sqlite3.connect(ns.db_path)
+    updated, deleted = refresh(conn, ns.processes)
+    conn.close()
+    sys.stderr.write("study_text rules version %s\n" % RULES_VERSION)
+    print("Updated %s studies, removed %s" % (updated, deleted))
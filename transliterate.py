@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# In-process transliteration to ASCII compatible with `iconv -t ascii//TRANSLIT`
+
+import unicodedata
+
+# iconv's transliterations of the non-ASCII characters found in study texts, of Latin letters without a decomposition
+# and of common typographic, currency and mathematical symbols, wherever the NFKD fallback of AsciiTable gives a
+# different result
+ASCII_REPLACEMENTS = {
+    '\u00a1': '!', '\u00a2': 'c', '\u00a3': 'GBP', '\u00a5': 'JPY', '\u00a6': '|', '\u00a9': '(C)', '\u00ab': '<<',
+    '\u00ac': '!', '\u00ad': '-', '\u00ae': '(R)', '\u00b1': '+-', '\u00b4': "'", '\u00b5': 'u', '\u00b7': '.',
+    '\u00b8': ',', '\u00bb': '>>', '\u00bc': ' 1/4 ', '\u00bd': ' 1/2 ', '\u00be': ' 3/4 ', '\u00c6': 'AE',
+    '\u00d0': 'D', '\u00d7': 'x', '\u00d8': 'O', '\u00de': 'TH', '\u00df': 'ss', '\u00e6': 'ae', '\u00f0': 'd',
+    '\u00f7': '/', '\u00f8': 'o', '\u00fe': 'th', '\u0110': 'D', '\u0111': 'd', '\u0126': 'H', '\u0127': 'h',
+    '\u0131': 'i', '\u0138': 'q', '\u0141': 'L', '\u0142': 'l', '\u0149': "'n", '\u014a': 'N', '\u014b': 'n',
+    '\u0152': 'OE', '\u0153': 'oe', '\u0166': 'T', '\u0167': 't', '\u0180': 'b', '\u0181': 'B', '\u0182': 'B',
+    '\u0183': 'b', '\u0187': 'C', '\u0188': 'c', '\u0189': 'D', '\u018a': 'D', '\u018b': 'D', '\u018c': 'd',
+    '\u0190': 'E', '\u0191': 'F', '\u0192': 'f', '\u0193': 'G', '\u0195': 'hv', '\u0196': 'I', '\u0197': 'I',
+    '\u0198': 'K', '\u0199': 'k', '\u019a': 'l', '\u019d': 'N', '\u019e': 'n', '\u01a2': 'OI', '\u01a3': 'oi',
+    '\u01a4': 'P', '\u01a5': 'p', '\u01ab': 't', '\u01ac': 'T', '\u01ad': 't', '\u01ae': 'T', '\u01b2': 'V',
+    '\u01b3': 'Y', '\u01b4': 'y', '\u01b5': 'Z', '\u01b6': 'z', '\u01e2': 'AE', '\u01e3': 'ae', '\u01e4': 'G',
+    '\u01e5': 'g', '\u01fc': 'AE', '\u01fd': 'ae', '\u01fe': 'O', '\u01ff': 'o', '\u0221': 'd', '\u0224': 'Z',
+    '\u0225': 'z', '\u0234': 'l', '\u0235': 'n', '\u0236': 't', '\u0237': 'j', '\u0238': 'db', '\u0239': 'qp',
+    '\u023a': 'A', '\u023b': 'C', '\u023c': 'c', '\u023d': 'L', '\u023e': 'T', '\u023f': 's', '\u0240': 'z',
+    '\u0243': 'B', '\u0244': 'U', '\u0246': 'E', '\u0247': 'e', '\u0248': 'J', '\u0249': 'j', '\u024c': 'R',
+    '\u024d': 'r', '\u024e': 'Y', '\u024f': 'y', '\u0253': 'b', '\u0255': 'c', '\u0256': 'd', '\u0257': 'd',
+    '\u025b': 'e', '\u025f': 'j', '\u0260': 'g', '\u0261': 'g', '\u0262': 'G', '\u0266': 'h', '\u0267': 'h',
+    '\u0268': 'i', '\u026a': 'I', '\u026b': 'l', '\u026c': 'l', '\u026d': 'l', '\u0271': 'm', '\u0272': 'n',
+    '\u0273': 'n', '\u0274': 'N', '\u0276': 'OE', '\u027c': 'r', '\u027d': 'r', '\u027e': 'r', '\u0280': 'R',
+    '\u0282': 's', '\u0288': 't', '\u0289': 'u', '\u028b': 'v', '\u028f': 'Y', '\u0290': 'z', '\u0291': 'z',
+    '\u0299': 'B', '\u029b': 'G', '\u029c': 'H', '\u029d': 'j', '\u029f': 'L', '\u02a0': 'q', '\u02a3': 'dz',
+    '\u02a5': 'dz', '\u02a6': 'ts', '\u02aa': 'ls', '\u02ab': 'lz', '\u02bc': "'", '\u02c6': '^', '\u02c8': "'",
+    '\u02cb': '`', '\u02cd': '_', '\u02d0': ':', '\u02dc': '~', '\u02dd': "''", '\u03bc': 'u', '\u1e9c': 's',
+    '\u1e9d': 's', '\u1e9e': 'SS', '\u1efa': 'LL', '\u1efb': 'll', '\u1efc': 'V', '\u1efd': 'v', '\u1efe': 'Y',
+    '\u1eff': 'y', '\u2007': '?', '\u200b': '', '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2013': '-',
+    '\u2014': '--', '\u2015': '-', '\u2018': "'", '\u2019': "'", '\u201a': ',', '\u201b': "'", '\u201c': '"',
+    '\u201d': '"', '\u201e': ',,', '\u201f': '"', '\u2020': '+', '\u2022': 'o', '\u2035': '`', '\u2036': '``',
+    '\u2037': '```', '\u2039': '<', '\u203a': '>', '\u2044': '/', '\u204a': '&', '\u20a0': 'CE', '\u20a1': 'C=',
+    '\u20a2': 'Cr', '\u20a3': 'Fr.', '\u20a4': 'L.', '\u20a7': 'Pts', '\u20a9': 'KRW', '\u20aa': 'ILS',
+    '\u20ab': 'Dong', '\u20ac': 'EUR', '\u20af': 'GRD', '\u20b1': 'PHP', '\u20b4': 'UAH', '\u20b8': 'KZT',
+    '\u20b9': 'INR', '\u20ba': 'TL', '\u20bd': 'RUB', '\u20be': 'GEL', '\u2103': '?', '\u2109': '?', '\u211e': 'Rx',
+    '\u2122': '(TM)', '\u212e': 'e', '\u2150': ' 1/7 ', '\u2151': ' 1/9 ', '\u2152': ' 1/10 ', '\u2153': ' 1/3 ',
+    '\u2154': ' 2/3 ', '\u2155': ' 1/5 ', '\u2156': ' 2/5 ', '\u2157': ' 3/5 ', '\u2158': ' 4/5 ', '\u2159': ' 1/6 ',
+    '\u215a': ' 5/6 ', '\u215b': ' 1/8 ', '\u215c': ' 3/8 ', '\u215d': ' 5/8 ', '\u215e': ' 7/8 ', '\u215f': ' 1/ ',
+    '\u2189': ' 0/3 ', '\u2190': '<-', '\u2192': '->', '\u2194': '<->', '\u21ae': '!<->', '\u21cd': '!<=',
+    '\u21ce': '!<=>', '\u21cf': '!=>', '\u21d0': '<=', '\u21d2': '=>', '\u21d4': '<=>', '\u2212': '-', '\u2215': '/',
+    '\u2216': '\\', '\u2217': '*', '\u2223': '|', '\u2225': '||', '\u2236': ':', '\u223c': '~', '\u2241': '!~',
+    '\u2244': '!~-', '\u2247': '!~=', '\u2249': '!~~', '\u2260': '!=', '\u2262': '!==', '\u2264': '<=', '\u2265': '>=',
+    '\u226a': '<<', '\u226b': '>>', '\u226e': '!<', '\u226f': '!>', '\u2270': '!<=', '\u2271': '!>=', '\u2274': '!<~',
+    '\u2275': '!>~', '\u2278': '!<>', '\u2279': '!><', '\u22d8': '<<<', '\u22d9': '>>>', '\u25e6': 'o', '\u3008': '<',
+    '\u3009': '>', '\ufeff': '',
+}
+# circled digits and letters keep their circle as parentheses
+ASCII_REPLACEMENTS.update((chr(0x2460 + i), '(%d)' % (i + 1)) for i in range(20))
+ASCII_REPLACEMENTS.update((chr(0x24b6 + i), '(%s)' % chr(ord('A') + i)) for i in range(26))
+ASCII_REPLACEMENTS.update((chr(0x24d0 + i), '(%s)' % chr(ord('a') + i)) for i in range(26))
+ASCII_REPLACEMENTS['\u24ea'] = '(0)'
+# joiners and bidirectional controls, which iconv doesn't drop like the other formatting characters
+ASCII_REPLACEMENTS.update((chr(c), '?') for c in [0x200c, 0x200d, 0x200e, 0x200f, 0x202a, 0x202b, 0x202c, 0x202d,
+                                                  0x202e, 0x2064] + list(range(0x2066, 0x2070)))
+
+
+class AsciiTable(dict):
+    """
+    str.translate() table mapping code points to their ASCII transliteration. Characters missing from
+    ASCII_REPLACEMENTS are dropped if they are combining marks or formatting characters, or else decomposed with NFKD,
+    keeping the ASCII part (accented letters lose their accents, fullwidth forms become ASCII), or become '?' like in
+    iconv when there is none. Each result is memoized in the table.
+    """
+
+    def __missing__(self, key):
+        ch = chr(key)
+        if key < 128:
+            value = ch
+        elif unicodedata.category(ch) in ('Mn', 'Me', 'Cf'):  # combining marks and invisible formatting characters
+            value = ''
+        else:
+            value = ''.join(c for c in unicodedata.normalize('NFKD', ch) if ord(c) < 128)
+            if not value.strip() and unicodedata.category(ch) != 'Zs':  # spacing accents decompose to a space
+                value = '?'
+        self[key] = value
+        return value
+
+
+ASCII_TABLE = AsciiTable((ord(k), v) for k, v in ASCII_REPLACEMENTS.items())
+
+
+def to_ascii(text):
+    """Returns text transliterated to ASCII"""
+    try:
+        text.encode('ascii')
+        return text
+    except UnicodeEncodeError:
+        return text.translate(ASCII_TABLE)
+
+
+def to_ascii_all(texts):
+    """Returns a list of the texts transliterated to ASCII"""
+    return [to_ascii(text) for text in texts]